@@ -1,14 +1,133 @@
+from contextlib import asynccontextmanager, contextmanager
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
-import grpc, os
+import grpc, itertools, json, os, threading
 
 import api_pb2, api_pb2_grpc
 
+# Comma-separated "host:port" lists; calls are spread round-robin across them.
 AUTH_ADDR = os.environ.get("AUTH_ADDR", "auth:50051")
 CHALLENGE_ADDR = os.environ.get("CHALLENGE_ADDR", "challenge:50052")
 SUBMISSION_ADDR = os.environ.get("SUBMISSION_ADDR", "submission:50053")
+EVALUATOR_ADDR = os.environ.get("EVALUATOR_ADDR", "evaluator:50054")
+LEADERBOARD_ADDR = os.environ.get("LEADERBOARD_ADDR", "leaderboard:50055")
+
+CHANNELS_PER_ADDR = int(os.environ.get("CHANNELS_PER_ADDR", "2"))
+MAX_STREAMS_PER_CHANNEL = int(os.environ.get("MAX_STREAMS_PER_CHANNEL", "100"))  # matches the server's default SETTINGS
+KEEPALIVE_TIME_MS = int(os.environ.get("KEEPALIVE_TIME_MS", "30000"))
+KEEPALIVE_TIMEOUT_MS = int(os.environ.get("KEEPALIVE_TIMEOUT_MS", "10000"))
+# each yielded chunk costs a threadpool hop, so stream listings in groups of lines
+NDJSON_FLUSH_LINES = int(os.environ.get("NDJSON_FLUSH_LINES", "200"))
+
+CHANNEL_OPTIONS = [
+    ("grpc.keepalive_time_ms", KEEPALIVE_TIME_MS),
+    ("grpc.keepalive_timeout_ms", KEEPALIVE_TIMEOUT_MS),
+    ("grpc.keepalive_permit_without_calls", 1),
+    ("grpc.http2.max_pings_without_data", 0),
+    # a DNS name that resolves to several replicas is balanced inside the channel too
+    ("grpc.lb_policy_name", "round_robin"),
+    # separate channels to one address get separate HTTP/2 connections
+    ("grpc.use_local_subchannel_pool", 1),
+]
+
+
+class _Channel:
+    def __init__(self, addr: str, stub_cls):
+        self.addr = addr
+        self.channel = grpc.insecure_channel(addr, options=CHANNEL_OPTIONS)
+        self.stub = stub_cls(self.channel)
+        self.state = "IDLE"
+        self.inflight = 0
+        self.calls = 0
+        self.errors = 0
+        self.channel.subscribe(self._on_state, try_to_connect=True)
+
+    def _on_state(self, connectivity):
+        self.state = connectivity.name
+
+
+class ChannelPool:
+    """Long-lived channels to one backend, reused by every request.
+
+    Each call takes the next channel in round-robin order that has fewer than
+    MAX_STREAMS_PER_CHANNEL calls in flight, so concurrent requests multiplex
+    over a few HTTP/2 connections instead of dialing a new one each time.
+    When every channel is full the least busy one is used and gRPC queues the
+    stream until the server grants it.
+    """
+
+    def __init__(self, name: str, addrs: str, stub_cls):
+        self.name = name
+        self.addrs = [a.strip() for a in addrs.split(",") if a.strip()]
+        self.channels = [_Channel(a, stub_cls) for _ in range(CHANNELS_PER_ADDR) for a in self.addrs]
+        self._rr = itertools.cycle(range(len(self.channels)))
+        self._lock = threading.Lock()
+        self.saturated = 0
+
+    def _pick(self) -> _Channel:
+        with self._lock:
+            for _ in range(len(self.channels)):
+                ch = self.channels[next(self._rr)]
+                if ch.inflight < MAX_STREAMS_PER_CHANNEL:
+                    break
+            else:
+                ch = min(self.channels, key=lambda c: c.inflight)
+                self.saturated += 1
+            ch.inflight += 1
+            ch.calls += 1
+            return ch
+
+    @contextmanager
+    def stub(self):
+        ch = self._pick()
+        try:
+            yield ch.stub
+        except grpc.RpcError:
+            ch.errors += 1
+            raise
+        finally:
+            with self._lock:
+                ch.inflight -= 1
+
+    def stats(self) -> dict:
+        return {
+            "addresses": self.addrs,
+            "inflight": sum(c.inflight for c in self.channels),
+            "saturated": self.saturated,
+            "channels": [{"addr": c.addr, "state": c.state, "inflight": c.inflight,
+                          "calls": c.calls, "errors": c.errors} for c in self.channels],
+        }
+
+    def close(self):
+        for c in self.channels:
+            c.channel.close()
+
+
+POOLS = {
+    "auth": ChannelPool("auth", AUTH_ADDR, api_pb2_grpc.AuthServiceStub),
+    "challenge": ChannelPool("challenge", CHALLENGE_ADDR, api_pb2_grpc.ChallengeServiceStub),
+    "submission": ChannelPool("submission", SUBMISSION_ADDR, api_pb2_grpc.SubmissionServiceStub),
+    "evaluator": ChannelPool("evaluator", EVALUATOR_ADDR, api_pb2_grpc.EvaluatorServiceStub),
+    "leaderboard": ChannelPool("leaderboard", LEADERBOARD_ADDR, api_pb2_grpc.LeaderboardServiceStub),
+}
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    for pool in POOLS.values():
+        pool.close()
 
-app = FastAPI(title="HTTP API Gateway (to gRPC microservices)")
+
+app = FastAPI(title="HTTP API Gateway (to gRPC microservices)", lifespan=lifespan)
+
+RPC_STATUS = {grpc.StatusCode.INVALID_ARGUMENT: 400, grpc.StatusCode.RESOURCE_EXHAUSTED: 503,
+              grpc.StatusCode.UNAVAILABLE: 503}
+
+@app.exception_handler(grpc.RpcError)
+def rpc_error(request, exc: grpc.RpcError):
+    return JSONResponse(status_code=RPC_STATUS.get(exc.code(), 502), content={"detail": exc.details()})
 
 # --------- Schemas ----------
 class RegisterIn(BaseModel):
@@ -19,6 +138,9 @@ class LoginIn(BaseModel):
     username: str
     password: str
 
+class LogoutIn(BaseModel):
+    token: str
+
 class CreateChallengeIn(BaseModel):
     token: str
     title: str
@@ -30,97 +152,93 @@ class SubmitIn(BaseModel):
     artifact: str
 
 # --------- Helpers ----------
-def auth_stub():
-    ch = grpc.insecure_channel(AUTH_ADDR)
-    return api_pb2_grpc.AuthServiceStub(ch), ch
+def challenge_dict(c):
+    return {"id": c.id, "title": c.title, "description": c.description, "owner_user_id": c.owner_user_id}
 
-def challenge_stub():
-    ch = grpc.insecure_channel(CHALLENGE_ADDR)
-    return api_pb2_grpc.ChallengeServiceStub(ch), ch
+def submission_dict(s):
+    return {"id": s.id, "challenge_id": s.challenge_id, "user_id": s.user_id, "artifact": s.artifact}
 
-def submission_stub():
-    ch = grpc.insecure_channel(SUBMISSION_ADDR)
-    return api_pb2_grpc.SubmissionServiceStub(ch), ch
+def ndjson(pool, method, request, to_dict):
+    """Relay a server-streaming RPC as NDJSON, flushing every NDJSON_FLUSH_LINES messages."""
+    with POOLS[pool].stub() as stub:
+        call = getattr(stub, method)(request)
+        try:
+            lines = []
+            for msg in call:
+                lines.append(json.dumps(to_dict(msg)))
+                if len(lines) >= NDJSON_FLUSH_LINES:
+                    yield "\n".join(lines) + "\n"
+                    lines = []
+            if lines:
+                yield "\n".join(lines) + "\n"
+        finally:
+            call.cancel()  # no-op once finished; stops the backend if the client went away
 
 # --------- Routes -----------
 @app.post("/register")
 def register(payload: RegisterIn):
-    stub, ch = auth_stub()
-    try:
+    with POOLS["auth"].stub() as stub:
         resp = stub.Register(api_pb2.RegisterRequest(username=payload.username, password=payload.password))
         if not resp.ok:
             raise HTTPException(status_code=400, detail=resp.message)
         return {"ok": True, "user": {"id": resp.user.id, "username": resp.user.username}}
-    finally:
-        ch.close()
 
 @app.post("/login")
 def login(payload: LoginIn):
-    stub, ch = auth_stub()
-    try:
+    with POOLS["auth"].stub() as stub:
         resp = stub.Login(api_pb2.LoginRequest(username=payload.username, password=payload.password))
         if not resp.ok:
             raise HTTPException(status_code=401, detail=resp.message)
         return {"ok": True, "token": resp.token, "user": {"id": resp.user.id, "username": resp.user.username}}
-    finally:
-        ch.close()
+
+@app.post("/logout")
+def logout(payload: LogoutIn):
+    with POOLS["auth"].stub() as stub:
+        resp = stub.Logout(api_pb2.LogoutRequest(token=payload.token))
+        if not resp.ok:
+            raise HTTPException(status_code=401, detail=resp.message)
+        return {"ok": True}
 
 @app.post("/challenges")
 def create_challenge(payload: CreateChallengeIn):
-    stub, ch = challenge_stub()
-    try:
+    with POOLS["challenge"].stub() as stub:
         resp = stub.CreateChallenge(api_pb2.CreateChallengeRequest(token=payload.token, title=payload.title, description=payload.description))
         if not resp.ok:
             raise HTTPException(status_code=401, detail=resp.message)
-        c = resp.challenge
-        return {"ok": True, "challenge": {"id": c.id, "title": c.title, "description": c.description, "owner_user_id": c.owner_user_id}}
-    finally:
-        ch.close()
+        return {"ok": True, "challenge": challenge_dict(resp.challenge)}
 
 @app.get("/challenges")
-def list_challenges():
-    stub, ch = challenge_stub()
-    try:
-        resp = stub.ListChallenges(api_pb2.ListChallengesRequest())
-        return {"items": [{"id": c.id, "title": c.title, "description": c.description, "owner_user_id": c.owner_user_id} for c in resp.items]}
-    finally:
-        ch.close()
+def list_challenges(page_size: int = 100, page_token: str = ""):
+    with POOLS["challenge"].stub() as stub:
+        resp = stub.ListChallenges(api_pb2.ListChallengesRequest(page_size=page_size, page_token=page_token))
+        return {"items": [challenge_dict(c) for c in resp.items], "next_page_token": resp.next_page_token}
+
+@app.get("/challenges/stream")
+def stream_challenges(page_token: str = ""):
+    return StreamingResponse(ndjson("challenge", "StreamChallenges", api_pb2.ListChallengesRequest(page_token=page_token),
+                                    challenge_dict), media_type="application/x-ndjson")
 
 @app.post("/submit")
 def submit(payload: SubmitIn):
-    stub, ch = submission_stub()
-    try:
+    with POOLS["submission"].stub() as stub:
         resp = stub.SubmitModel(api_pb2.SubmitModelRequest(token=payload.token, challenge_id=payload.challenge_id, artifact=payload.artifact))
         if not resp.ok:
             raise HTTPException(status_code=401, detail=resp.message)
-        s = resp.submission
-        return {"ok": True, "submission": {"id": s.id, "challenge_id": s.challenge_id, "user_id": s.user_id, "artifact": s.artifact}}
-    finally:
-        ch.close()
+        return {"ok": True, "submission": submission_dict(resp.submission)}
 
 @app.get("/submissions")
-def list_submissions(challenge_id: str):
-    stub, ch = submission_stub()
-    try:
-        resp = stub.ListSubmissions(api_pb2.ListSubmissionsRequest(challenge_id=challenge_id))
-        return {"items": [{"id": s.id, "challenge_id": s.challenge_id, "user_id": s.user_id, "artifact": s.artifact} for s in resp.items]}
-    finally:
-        ch.close()
+def list_submissions(challenge_id: str, page_size: int = 100, page_token: str = ""):
+    with POOLS["submission"].stub() as stub:
+        resp = stub.ListSubmissions(api_pb2.ListSubmissionsRequest(challenge_id=challenge_id, page_size=page_size,
+                                                                    page_token=page_token))
+        return {"items": [submission_dict(s) for s in resp.items], "next_page_token": resp.next_page_token}
 
+@app.get("/submissions/stream")
+def stream_submissions(challenge_id: str, page_token: str = ""):
+    req = api_pb2.ListSubmissionsRequest(challenge_id=challenge_id, page_token=page_token)
+    return StreamingResponse(ndjson("submission", "StreamSubmissions", req, submission_dict),
+                             media_type="application/x-ndjson")
 
-# ---- NEW: evaluator & leaderboard wiring ----
-EVALUATOR_ADDR = os.environ.get("EVALUATOR_ADDR", "evaluator:50054")
-LEADERBOARD_ADDR = os.environ.get("LEADERBOARD_ADDR", "leaderboard:50055")
-
-def evaluator_stub():
-    ch = grpc.insecure_channel(EVALUATOR_ADDR)
-    stub = api_pb2_grpc.EvaluatorServiceStub(ch)
-    return stub, ch
-
-def leaderboard_stub():
-    ch = grpc.insecure_channel(LEADERBOARD_ADDR)
-    stub = api_pb2_grpc.LeaderboardServiceStub(ch)
-    return stub, ch
 
 class EvaluateIn(BaseModel):
     submission_id: str
@@ -128,22 +246,38 @@ class EvaluateIn(BaseModel):
 
 @app.post("/evaluate")
 def evaluate(inp: EvaluateIn):
-    stub, ch = evaluator_stub()
-    try:
+    with POOLS["evaluator"].stub() as stub:
         req = api_pb2.EvaluateRequest(submission_id=inp.submission_id, challenge_id=inp.challenge_id or "default")
         resp = stub.Evaluate(req)
         if not resp.ok:
             raise HTTPException(status_code=400, detail=resp.message)
         return {"ok": True, "submission_id": resp.submission_id, "score": resp.score}
-    finally:
-        ch.close()
+
+class EvaluateBatchIn(BaseModel):
+    challenge_id: str = ""
+    submission_ids: list[str] = []  # empty: re-score every submission of the challenge
+
+@app.post("/evaluate/batch")
+def evaluate_batch(inp: EvaluateBatchIn):
+    with POOLS["evaluator"].stub() as stub:
+        resp = stub.EvaluateBatch(api_pb2.EvaluateBatchRequest(challenge_id=inp.challenge_id,
+                                                               submission_ids=inp.submission_ids))
+        if not resp.ok:
+            raise HTTPException(status_code=400, detail=resp.message)
+        return {"ok": True, "challenge_id": resp.challenge_id, "count": len(resp.results),
+                "results": [{"submission_id": r.submission_id, "score": r.score} for r in resp.results]}
 
 @app.get("/leaderboard")
-def get_leaderboard(challenge_id: str = "default"):
-    stub, ch = leaderboard_stub()
-    try:
-        resp = stub.GetLeaderboard(api_pb2.GetLeaderboardRequest(challenge_id=challenge_id))
-        items = [{"submission_id": e.submission_id, "score": e.score} for e in resp.entries]
-        return {"challenge_id": challenge_id, "entries": items}
-    finally:
-        ch.close()
+def get_leaderboard(challenge_id: str = "default", top_k: int = 100, offset: int = 0, submission_id: str = ""):
+    with POOLS["leaderboard"].stub() as stub:
+        resp = stub.GetLeaderboard(api_pb2.GetLeaderboardRequest(challenge_id=challenge_id, top_k=top_k, offset=offset,
+                                                                 rank_submission_id=submission_id))
+        items = [{"rank": e.rank, "submission_id": e.submission_id, "score": e.score} for e in resp.entries]
+        out = {"challenge_id": challenge_id, "total": resp.total, "entries": items}
+        if submission_id:
+            out["rank"] = {"submission_id": submission_id, "rank": resp.rank or None}
+        return out
+
+@app.get("/channels")
+def channels():
+    return {name: pool.stats() for name, pool in POOLS.items()}
@@ -1,90 +1,106 @@
-import os, sqlite3, uuid, bcrypt, time
+import asyncio, os, sqlite3, uuid, bcrypt, time
 import grpc
 from concurrent import futures
 
 import api_pb2, api_pb2_grpc
+from sqlitedb import Database
 
 DB_PATH = os.environ.get("DB_PATH", "/data/auth.db")
 PORT = os.environ.get("PORT", "50051")
+MAX_CONCURRENT_RPCS = int(os.environ.get("MAX_CONCURRENT_RPCS", "256"))  # beyond this, calls fail with RESOURCE_EXHAUSTED
+BCRYPT_THREADS = int(os.environ.get("BCRYPT_THREADS", str(os.cpu_count() or 1)))
 
 os.makedirs("/data", exist_ok=True)
 
-def get_db():
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-    conn.execute("""
-    CREATE TABLE IF NOT EXISTS users(
-        id TEXT PRIMARY KEY,
-        username TEXT UNIQUE,
-        password_hash BLOB
-    );
-    """)
-    conn.execute("""
-    CREATE TABLE IF NOT EXISTS sessions(
-        token TEXT PRIMARY KEY,
-        user_id TEXT,
-        created_at REAL
-    );
-    """)
-    conn.commit()
-    return conn
+db = Database(DB_PATH, """
+CREATE TABLE IF NOT EXISTS users(
+    id TEXT PRIMARY KEY,
+    username TEXT UNIQUE,
+    password_hash BLOB
+);
+CREATE TABLE IF NOT EXISTS sessions(
+    token TEXT PRIMARY KEY,
+    user_id TEXT,
+    created_at REAL
+);
+""")
 
-db = get_db()
+# bcrypt releases the GIL, so it gets a thread per core off the event loop
+bcrypt_executor = futures.ThreadPoolExecutor(max_workers=BCRYPT_THREADS, thread_name_prefix="bcrypt")
+
+async def run_bcrypt(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(bcrypt_executor, fn, *args)
+
+# one queue per open WatchRevocations stream
+watchers = set()
 
 class AuthService(api_pb2_grpc.AuthServiceServicer):
-    def Register(self, request, context):
+    async def Register(self, request, context):
         username = request.username.strip()
         password = request.password.encode("utf-8")
         if not username or not password:
             return api_pb2.RegisterResponse(ok=False, message="empty username/password")
         user_id = str(uuid.uuid4())
-        pw_hash = bcrypt.hashpw(password, bcrypt.gensalt())
+        pw_hash = await run_bcrypt(bcrypt.hashpw, password, bcrypt.gensalt())
         try:
-            db.execute("INSERT INTO users(id, username, password_hash) VALUES(?,?,?)",
-                       (user_id, username, pw_hash))
-            db.commit()
+            await db.execute("INSERT INTO users(id, username, password_hash) VALUES(?,?,?)",
+                             (user_id, username, pw_hash))
         except sqlite3.IntegrityError:
             return api_pb2.RegisterResponse(ok=False, message="username already exists")
         return api_pb2.RegisterResponse(ok=True, message="registered",
                                         user=api_pb2.User(id=user_id, username=username))
 
-    def Login(self, request, context):
+    async def Login(self, request, context):
         username = request.username.strip()
         password = request.password.encode("utf-8")
-        cur = db.execute("SELECT id, password_hash FROM users WHERE username=?", (username,))
-        row = cur.fetchone()
+        row = await db.fetchone("SELECT id, password_hash FROM users WHERE username=?", (username,))
         if not row:
             return api_pb2.LoginResponse(ok=False, message="user not found")
         user_id, stored_hash = row[0], row[1]
-        if not bcrypt.checkpw(password, stored_hash):
+        if not await run_bcrypt(bcrypt.checkpw, password, stored_hash):
             return api_pb2.LoginResponse(ok=False, message="invalid password")
         token = str(uuid.uuid4())
-        db.execute("INSERT INTO sessions(token, user_id, created_at) VALUES(?,?,?)",
-                   (token, user_id, time.time()))
-        db.commit()
+        await db.execute("INSERT INTO sessions(token, user_id, created_at) VALUES(?,?,?)",
+                         (token, user_id, time.time()))
         return api_pb2.LoginResponse(ok=True, message="ok", token=token,
                                      user=api_pb2.User(id=user_id, username=username))
 
-    def ValidateToken(self, request, context):
-        token = request.token
-        cur = db.execute("SELECT user_id FROM sessions WHERE token=?", (token,))
-        row = cur.fetchone()
+    async def ValidateToken(self, request, context):
+        row = await db.fetchone("SELECT s.user_id, u.username FROM sessions s JOIN users u ON u.id = s.user_id "
+                                "WHERE s.token=?", (request.token,))
         if not row:
             return api_pb2.ValidateTokenResponse(ok=False, message="invalid token")
-        user_id = row[0]
-        cur = db.execute("SELECT username FROM users WHERE id=?", (user_id,))
-        r2 = cur.fetchone()
-        if not r2:
-            return api_pb2.ValidateTokenResponse(ok=False, message="user not found")
         return api_pb2.ValidateTokenResponse(ok=True, message="ok",
-                                             user=api_pb2.User(id=user_id, username=r2[0]))
+                                             user=api_pb2.User(id=row[0], username=row[1]))
+
+    async def Logout(self, request, context):
+        if not await db.execute("DELETE FROM sessions WHERE token=?", (request.token,)):
+            return api_pb2.LogoutResponse(ok=False, message="invalid token")
+        for q in watchers:
+            q.put_nowait(request.token)
+        return api_pb2.LogoutResponse(ok=True, message="logged out")
+
+    async def WatchRevocations(self, request, context):
+        q = asyncio.Queue()
+        watchers.add(q)
+        try:
+            yield api_pb2.RevocationEvent()
+            while True:
+                yield api_pb2.RevocationEvent(token=await q.get())
+        finally:
+            watchers.discard(q)
 
-def serve():
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
+async def serve():
+    server = grpc.aio.server(maximum_concurrent_rpcs=MAX_CONCURRENT_RPCS, options=[
+        # accept the gateway's keepalive pings on idle channels
+        ("grpc.keepalive_permit_without_calls", 1),
+        ("grpc.http2.min_recv_ping_interval_without_data_ms", 10000),
+    ])
     api_pb2_grpc.add_AuthServiceServicer_to_server(AuthService(), server)
     server.add_insecure_port(f"[::]:{PORT}")
     print(f"AuthService listening on {PORT}")
-    server.start()
-    server.wait_for_termination()
+    await server.start()
+    await server.wait_for_termination()
 
 if __name__ == "__main__":
-    serve()
+    asyncio.run(serve())
@@ -1,62 +1,81 @@
-import os, sqlite3, uuid
+import asyncio, os, uuid
 import grpc
-from concurrent import futures
 
 import api_pb2, api_pb2_grpc
+from authcache import AuthCache
+from sqlitedb import Database
 
 AUTH_ADDR = os.environ.get("AUTH_ADDR", "auth:50051")
 DB_PATH = os.environ.get("DB_PATH", "/data/challenge.db")
 PORT = os.environ.get("PORT", "50052")
+MAX_CONCURRENT_RPCS = int(os.environ.get("MAX_CONCURRENT_RPCS", "256"))  # beyond this, calls fail with RESOURCE_EXHAUSTED
+DEFAULT_PAGE_SIZE = int(os.environ.get("DEFAULT_PAGE_SIZE", "100"))
+MAX_PAGE_SIZE = int(os.environ.get("MAX_PAGE_SIZE", "1000"))
 
 os.makedirs("/data", exist_ok=True)
 
-def get_db():
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-    conn.execute("""
-    CREATE TABLE IF NOT EXISTS challenges(
-        id TEXT PRIMARY KEY,
-        title TEXT,
-        description TEXT,
-        owner_user_id TEXT
-    );
-    """)
-    conn.commit()
-    return conn
-
-db = get_db()
-
-def validate_token(token: str):
-    with grpc.insecure_channel(AUTH_ADDR) as ch:
-        stub = api_pb2_grpc.AuthServiceStub(ch)
-        resp = stub.ValidateToken(api_pb2.ValidateTokenRequest(token=token))
-        return resp
+db = Database(DB_PATH, """
+CREATE TABLE IF NOT EXISTS challenges(
+    id TEXT PRIMARY KEY,
+    title TEXT,
+    description TEXT,
+    owner_user_id TEXT
+);
+""")
+
+# rows are paged by rowid, i.e. in insertion order; the page token is the last rowid returned
+COLUMNS = "rowid, id, title, description, owner_user_id"
+
+def to_challenge(r):
+    return api_pb2.Challenge(id=r[1], title=r[2], description=r[3], owner_user_id=r[4])
+
+async def page_args(request, context):
+    try:
+        after = int(request.page_token) if request.page_token else 0
+    except ValueError:
+        await context.abort(grpc.StatusCode.INVALID_ARGUMENT, "bad page_token")
+    return after, min(request.page_size if request.page_size > 0 else DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
 
 class ChallengeService(api_pb2_grpc.ChallengeServiceServicer):
-    def CreateChallenge(self, request, context):
-        v = validate_token(request.token)
+    def __init__(self, auth: AuthCache):
+        self.auth = auth
+
+    async def CreateChallenge(self, request, context):
+        v = await self.auth.validate(request.token)
         if not v.ok:
             return api_pb2.CreateChallengeResponse(ok=False, message="unauthorized")
         cid = str(uuid.uuid4())
-        db.execute("INSERT INTO challenges(id, title, description, owner_user_id) VALUES(?,?,?,?)",
-                   (cid, request.title.strip(), request.description.strip(), v.user.id))
-        db.commit()
+        await db.execute("INSERT INTO challenges(id, title, description, owner_user_id) VALUES(?,?,?,?)",
+                         (cid, request.title.strip(), request.description.strip(), v.user.id))
         ch = api_pb2.Challenge(id=cid, title=request.title.strip(),
                                description=request.description.strip(),
                                owner_user_id=v.user.id)
         return api_pb2.CreateChallengeResponse(ok=True, message="created", challenge=ch)
 
-    def ListChallenges(self, request, context):
-        rows = db.execute("SELECT id, title, description, owner_user_id FROM challenges").fetchall()
-        items = [api_pb2.Challenge(id=r[0], title=r[1], description=r[2], owner_user_id=r[3]) for r in rows]
-        return api_pb2.ListChallengesResponse(items=items)
+    async def ListChallenges(self, request, context):
+        after, size = await page_args(request, context)
+        rows = await db.fetchall(f"SELECT {COLUMNS} FROM challenges WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                                 (after, size + 1))
+        next_token = str(rows[size - 1][0]) if len(rows) > size else ""
+        return api_pb2.ListChallengesResponse(items=[to_challenge(r) for r in rows[:size]], next_page_token=next_token)
+
+    async def StreamChallenges(self, request, context):
+        after, _ = await page_args(request, context)
+        async for r in db.iterate(f"SELECT {COLUMNS} FROM challenges WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                                  after=after):
+            yield to_challenge(r)
 
-def serve():
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
-    api_pb2_grpc.add_ChallengeServiceServicer_to_server(ChallengeService(), server)
+async def serve():
+    server = grpc.aio.server(maximum_concurrent_rpcs=MAX_CONCURRENT_RPCS, options=[
+        # accept the gateway's keepalive pings on idle channels
+        ("grpc.keepalive_permit_without_calls", 1),
+        ("grpc.http2.min_recv_ping_interval_without_data_ms", 10000),
+    ])
+    api_pb2_grpc.add_ChallengeServiceServicer_to_server(ChallengeService(AuthCache(AUTH_ADDR)), server)
     server.add_insecure_port(f"[::]:{PORT}")
     print(f"ChallengeService listening on {PORT}")
-    server.start()
-    server.wait_for_termination()
+    await server.start()
+    await server.wait_for_termination()
 
 if __name__ == "__main__":
-    serve()
+    asyncio.run(serve())
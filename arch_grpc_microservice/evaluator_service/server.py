@@ -1,28 +1,163 @@
-import grpc, random
-from concurrent import futures
+import asyncio, collections, grpc, os
+import numpy as np
 import api_pb2, api_pb2_grpc
 
-SUBMISSION_ADDR = "submission:50053"
-LEADERBOARD_ADDR = "leaderboard:50055"
+SUBMISSION_ADDR = os.environ.get("SUBMISSION_ADDR", "submission:50053")
+LEADERBOARD_ADDR = os.environ.get("LEADERBOARD_ADDR", "leaderboard:50055")
+MAX_CONCURRENT_RPCS = int(os.environ.get("MAX_CONCURRENT_RPCS", "256"))  # beyond this, calls fail with RESOURCE_EXHAUSTED
+# an UpdateScores stream is half-closed after this long without new updates, or once it carried UPLOAD_MAX_ITEMS
+UPLOAD_LINGER_MS = float(os.environ.get("UPLOAD_LINGER_MS", "2"))
+UPLOAD_MAX_ITEMS = int(os.environ.get("UPLOAD_MAX_ITEMS", "10000"))
+UPLOAD_CHUNK = int(os.environ.get("UPLOAD_CHUNK", "1000"))  # updates per stream message
+UPLOAD_RETRIES = int(os.environ.get("UPLOAD_RETRIES", "3"))
+
+rng = np.random.default_rng()
+
+def score_batch(n: int) -> np.ndarray:
+    """Score n submissions in one vectorized pass (random scores stand in for a real metric)."""
+    return np.round(rng.uniform(0.0, 1.0, n), 4)
+
+def chunked(updates: list):
+    for i in range(0, len(updates), UPLOAD_CHUNK):
+        yield api_pb2.ScoreUpdates(updates=updates[i:i + UPLOAD_CHUNK])
+
+class ScoreUploader:
+    """Sends score updates to the leaderboard over a shared client-streaming UpdateScores call.
+
+    Updates queued while a stream is open ride on it, so concurrent evaluations share one call instead of
+    one RPC each. The stream lingers UPLOAD_LINGER_MS for more, except after a stream that carried a single
+    send(), so a lightly loaded evaluator does not wait; there a lone update goes out as a plain UpdateScore.
+    The leaderboard answers once the stream is half-closed, which acknowledges everything sent on it;
+    send() returns only then. A failed stream is resent whole on a new one: an update sets a score, so
+    applying it twice is harmless.
+    """
+
+    def __init__(self, stub: api_pb2_grpc.LeaderboardServiceStub):
+        self.stub = stub
+        self.pending = collections.deque()  # (updates, future)
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.last_sends = 0  # send() calls carried by the previous stream
+
+    async def send(self, updates: list):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+        fut = asyncio.get_running_loop().create_future()
+        self.pending.append((updates, fut))
+        self.wakeup.set()
+        await fut
+
+    async def _requests(self, batch: list, take_more: bool):
+        """Yield the batch, then keep moving queued updates onto it until idle or full."""
+        n = 0
+        for updates, _ in batch:
+            for msg in chunked(updates):
+                yield msg
+            n += len(updates)
+        linger = UPLOAD_LINGER_MS / 1000.0 if self.last_sends > 1 else 0.0
+        while take_more and n < UPLOAD_MAX_ITEMS:
+            if not self.pending:
+                if not linger:
+                    return
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), linger)
+                except asyncio.TimeoutError:
+                    return
+                continue
+            item = self.pending.popleft()
+            batch.append(item)
+            for msg in chunked(item[0]):
+                yield msg
+            n += len(item[0])
+
+    async def _run(self):
+        while True:
+            if not self.pending:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            batch = [self.pending.popleft()]
+            # a lone update on an idle uploader: a unary call is cheaper than opening a stream for it
+            lone = self.last_sends <= 1 and not self.pending and len(batch[0][0]) == 1
+            error = None
+            for attempt in range(UPLOAD_RETRIES + 1):
+                try:
+                    if lone:
+                        await self.stub.UpdateScore(batch[0][0][0])
+                    else:
+                        # only the first attempt takes new updates; a retry resends exactly what was lost
+                        await self.stub.UpdateScores(self._requests(batch, take_more=attempt == 0))
+                    error = None
+                    break
+                except grpc.aio.AioRpcError as e:
+                    error = e
+                    if attempt < UPLOAD_RETRIES:
+                        await asyncio.sleep(0.05 * 2 ** attempt)
+                except Exception as e:  # not retryable; fail this batch, keep serving the next one
+                    error = e
+                    break
+            for _, fut in batch:
+                if fut.done():  # sender was cancelled
+                    continue
+                if error is not None:
+                    fut.set_exception(error)
+                else:
+                    fut.set_result(None)
+            self.last_sends = len(batch)
 
 class EvaluatorService(api_pb2_grpc.EvaluatorServiceServicer):
-    def Evaluate(self, request, context):
+    def __init__(self, uploader: ScoreUploader, submissions: api_pb2_grpc.SubmissionServiceStub):
+        self.uploader = uploader
+        self.submissions = submissions
+
+    async def upload(self, updates, context):
+        try:
+            await self.uploader.send(updates)
+        except grpc.aio.AioRpcError as e:
+            await context.abort(grpc.StatusCode.UNAVAILABLE, f"leaderboard: {e.details()}")
+
+    async def Evaluate(self, request, context):
         sid = request.submission_id
-        score = round(random.uniform(0, 1), 4)
-        # In a real system we'd query SubmissionService for challenge_id
-        # For simplicity, assume challenge_id is unknown
-        with grpc.insecure_channel(LEADERBOARD_ADDR) as ch:
-            stub = api_pb2_grpc.LeaderboardServiceStub(ch)
-            stub.UpdateScore(api_pb2.UpdateScoreRequest(submission_id=sid, score=score, challenge_id="default"))
+        score = float(score_batch(1)[0])
+        await self.upload([api_pb2.UpdateScoreRequest(submission_id=sid, score=score,
+                                                      challenge_id=request.challenge_id)], context)
         return api_pb2.EvaluateResponse(ok=True, message="evaluated", submission_id=sid, score=score)
 
-def serve():
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=5))
-    api_pb2_grpc.add_EvaluatorServiceServicer_to_server(EvaluatorService(), server)
+    async def EvaluateBatch(self, request, context):
+        cid = request.challenge_id.strip()
+        ids = list(request.submission_ids)
+        if not ids:
+            if not cid:
+                await context.abort(grpc.StatusCode.INVALID_ARGUMENT, "challenge_id or submission_ids required")
+            try:
+                stream = self.submissions.StreamSubmissions(api_pb2.ListSubmissionsRequest(challenge_id=cid))
+                ids = [s.id async for s in stream]
+            except grpc.aio.AioRpcError as e:
+                await context.abort(grpc.StatusCode.UNAVAILABLE, f"submission: {e.details()}")
+        scores = score_batch(len(ids)).tolist()
+        await self.upload([api_pb2.UpdateScoreRequest(submission_id=sid, score=score, challenge_id=cid)
+                           for sid, score in zip(ids, scores)], context)
+        return api_pb2.EvaluateBatchResponse(
+            ok=True, message="evaluated", challenge_id=cid or "default",
+            results=[api_pb2.ScoredSubmission(submission_id=sid, score=score) for sid, score in zip(ids, scores)])
+
+async def serve():
+    server = grpc.aio.server(maximum_concurrent_rpcs=MAX_CONCURRENT_RPCS, options=[
+        # accept the gateway's keepalive pings on idle channels
+        ("grpc.keepalive_permit_without_calls", 1),
+        ("grpc.http2.min_recv_ping_interval_without_data_ms", 10000),
+    ])
+    # long-lived channels: score updates go out on shared UpdateScores streams
+    leaderboard = grpc.aio.insecure_channel(LEADERBOARD_ADDR)
+    submission = grpc.aio.insecure_channel(SUBMISSION_ADDR)
+    api_pb2_grpc.add_EvaluatorServiceServicer_to_server(
+        EvaluatorService(ScoreUploader(api_pb2_grpc.LeaderboardServiceStub(leaderboard)),
+                         api_pb2_grpc.SubmissionServiceStub(submission)), server)
     server.add_insecure_port("[::]:50054")
     print("EvaluatorService on 50054")
-    server.start()
-    server.wait_for_termination()
+    await server.start()
+    await server.wait_for_termination()
 
 if __name__ == "__main__":
-    serve()
+    asyncio.run(serve())
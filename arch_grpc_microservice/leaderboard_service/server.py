@@ -1,31 +1,119 @@
-import grpc
-from concurrent import futures
+import asyncio, grpc, os, signal, threading
+from sortedcontainers import SortedList
 import api_pb2, api_pb2_grpc
+from scorelog import ScoreLog
 
-data = {}
+MAX_CONCURRENT_RPCS = int(os.environ.get("MAX_CONCURRENT_RPCS", "256"))  # beyond this, calls fail with RESOURCE_EXHAUSTED
+DEFAULT_TOP_K = int(os.environ.get("DEFAULT_TOP_K", "100"))
+MAX_TOP_K = int(os.environ.get("MAX_TOP_K", "1000"))
+SCORE_DIR = os.environ.get("SCORE_DIR", "")  # empty: scores live in memory only
+
+class Board:
+    """One challenge's scores kept in rank order (best first, ties by submission id)."""
+
+    def __init__(self):
+        self.scores = {}  # submission_id -> score
+        self.order = SortedList()  # (-score, submission_id)
+        # handlers run on the event loop, but anything that reads a board from another thread takes this too
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_scores(cls, scores: dict) -> "Board":
+        """Bulk-load a recovered board with one sort instead of n inserts."""
+        board = cls()
+        board.scores = scores
+        board.order = SortedList((-score, sid) for sid, score in scores.items())
+        return board
+
+    def upsert(self, submission_id: str, score: float) -> bool:
+        """Insert or move an entry in O(log n); False if the score was already there."""
+        with self.lock:
+            old = self.scores.get(submission_id)
+            if old == score:
+                return False
+            if old is not None:
+                self.order.remove((-old, submission_id))
+            self.scores[submission_id] = score
+            self.order.add((-score, submission_id))
+            return True
+
+    def copy_scores(self) -> dict:
+        with self.lock:
+            return self.scores.copy()
+
+    def window(self, offset: int, k: int):
+        """(rank, submission_id, score) for ranks offset+1 .. offset+k, and the board size."""
+        with self.lock:
+            keys = self.order.islice(offset, offset + k)
+            return [(offset + i + 1, sid, -neg) for i, (neg, sid) in enumerate(keys)], len(self.order)
+
+    def rank(self, submission_id: str) -> int:
+        """1-based rank, 0 if the submission has no score."""
+        with self.lock:
+            score = self.scores.get(submission_id)
+            if score is None:
+                return 0
+            return self.order.bisect_left((-score, submission_id)) + 1
+
+boards = {}  # challenge_id -> Board
+scores_log = None  # ScoreLog when SCORE_DIR is set
+
+def snapshot_state():
+    # runs on the score-log thread
+    return [(cid, board.copy_scores()) for cid, board in list(boards.items())]
+
+def apply(update):
+    cid = update.challenge_id or "default"
+    board = boards.get(cid) or boards.setdefault(cid, Board())
+    if board.upsert(update.submission_id, update.score) and scores_log is not None:
+        scores_log.append(cid, update.submission_id, update.score)
 
 class LeaderboardService(api_pb2_grpc.LeaderboardServiceServicer):
-    def UpdateScore(self, request, context):
-        cid = request.challenge_id or "default"
-        data.setdefault(cid, [])
-        # remove old
-        data[cid] = [e for e in data[cid] if e.submission_id != request.submission_id]
-        entry = api_pb2.LeaderboardEntry(submission_id=request.submission_id, score=request.score)
-        data[cid].append(entry)
-        data[cid].sort(key=lambda e: e.score, reverse=True)
+    async def UpdateScore(self, request, context):
+        apply(request)
         return api_pb2.UpdateScoreResponse(ok=True, message="updated")
 
-    def GetLeaderboard(self, request, context):
-        cid = request.challenge_id or "default"
-        return api_pb2.GetLeaderboardResponse(entries=data.get(cid, []))
+    async def UpdateScores(self, request_iterator, context):
+        applied = 0
+        async for msg in request_iterator:
+            for update in msg.updates:
+                apply(update)
+            applied += len(msg.updates)
+        return api_pb2.UpdateScoresResponse(ok=True, message="updated", applied=applied)
+
+    async def GetLeaderboard(self, request, context):
+        board = boards.get(request.challenge_id or "default")
+        if board is None:
+            return api_pb2.GetLeaderboardResponse()
+        k = min(request.top_k if request.top_k > 0 else DEFAULT_TOP_K, MAX_TOP_K)
+        rows, total = board.window(max(request.offset, 0), k)
+        entries = [api_pb2.LeaderboardEntry(submission_id=sid, score=score, rank=rank) for rank, sid, score in rows]
+        rank = board.rank(request.rank_submission_id) if request.rank_submission_id else 0
+        return api_pb2.GetLeaderboardResponse(entries=entries, total=total, rank=rank)
 
-def serve():
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=5))
+async def serve():
+    global scores_log
+    if SCORE_DIR:
+        scores_log = ScoreLog(SCORE_DIR, snapshot_state)
+        for cid, scores in scores_log.recover().items():
+            boards[cid] = Board.from_scores(scores)
+        scores_log.start()
+        print(f"Recovered {sum(len(b.scores) for b in boards.values())} scores in {scores_log.stats['recovery_s']}s")
+    server = grpc.aio.server(maximum_concurrent_rpcs=MAX_CONCURRENT_RPCS, options=[
+        # accept the gateway's keepalive pings on idle channels
+        ("grpc.keepalive_permit_without_calls", 1),
+        ("grpc.http2.min_recv_ping_interval_without_data_ms", 10000),
+    ])
     api_pb2_grpc.add_LeaderboardServiceServicer_to_server(LeaderboardService(), server)
     server.add_insecure_port("[::]:50055")
     print("LeaderboardService on 50055")
-    server.start()
-    server.wait_for_termination()
+    await server.start()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, lambda: loop.create_task(server.stop(5)))
+    await server.wait_for_termination()
+    if scores_log is not None:
+        scores_log.close()  # flush what is still buffered
 
 if __name__ == "__main__":
-    serve()
+    asyncio.run(serve())
@@ -0,0 +1,116 @@
+"""Token validation against AuthService with a local cache.
+
+Challenge and submission validate a token on every write, and the answer for
+a given token almost never changes. ``AuthCache`` keeps one long-lived
+grpc.aio channel to AuthService and remembers ValidateToken answers per
+token: positive ones for ``AUTH_CACHE_TTL_S``, negative ones ("invalid
+token") for ``AUTH_CACHE_NEGATIVE_TTL_S``.
+
+A background task holds a ``WatchRevocations`` stream open and drops revoked
+tokens as AuthService pushes them. Positive answers are only served from the
+cache while that stream is subscribed; while it is down every call goes to
+AuthService, and the cache is cleared when the stream comes back, since
+revocations may have been missed in between.
+
+Every ``AUTH_CACHE_STATS_S`` with traffic, the hit/miss counters from
+``stats()`` are printed to the service log (0 turns that off).
+
+Create it from inside the server's event loop.
+"""
+from collections import OrderedDict
+import asyncio, os, time
+
+import grpc
+
+import api_pb2, api_pb2_grpc
+
+AUTH_CACHE_TTL_S = float(os.environ.get("AUTH_CACHE_TTL_S", "60"))
+AUTH_CACHE_NEGATIVE_TTL_S = float(os.environ.get("AUTH_CACHE_NEGATIVE_TTL_S", "5"))
+AUTH_CACHE_MAX_ENTRIES = int(os.environ.get("AUTH_CACHE_MAX_ENTRIES", "10000"))
+WATCH_RETRY_S = float(os.environ.get("AUTH_WATCH_RETRY_S", "1"))
+AUTH_CACHE_STATS_S = float(os.environ.get("AUTH_CACHE_STATS_S", "60"))
+
+CHANNEL_OPTIONS = [
+    ("grpc.keepalive_time_ms", 30000),
+    ("grpc.keepalive_timeout_ms", 10000),
+    ("grpc.keepalive_permit_without_calls", 1),
+    ("grpc.http2.max_pings_without_data", 0),
+]
+
+
+class AuthCache:
+    def __init__(self, addr: str):
+        self.channel = grpc.aio.insecure_channel(addr, options=CHANNEL_OPTIONS)
+        self.stub = api_pb2_grpc.AuthServiceStub(self.channel)
+        self.entries = OrderedDict()  # token -> (expires_at, ValidateTokenResponse), LRU order
+        # bumped by every revocation and reconnect; a lookup that started
+        # before a bump must not store its (possibly stale) answer
+        self.epoch = 0
+        self.subscribed = False
+        self.hits = self.negative_hits = self.misses = self.revoked = self.reconnects = 0
+        loop = asyncio.get_running_loop()
+        self.watch_task = loop.create_task(self._watch())
+        self.report_task = loop.create_task(self._report()) if AUTH_CACHE_STATS_S > 0 else None
+
+    async def validate(self, token: str) -> api_pb2.ValidateTokenResponse:
+        entry = self.entries.get(token)
+        if entry is not None and entry[0] > time.monotonic() and (self.subscribed or not entry[1].ok):
+            self.entries.move_to_end(token)
+            if entry[1].ok:
+                self.hits += 1
+            else:
+                self.negative_hits += 1
+            return entry[1]
+        self.misses += 1
+        epoch = self.epoch
+
+        resp = await self.stub.ValidateToken(api_pb2.ValidateTokenRequest(token=token))
+
+        ttl = AUTH_CACHE_TTL_S if resp.ok else AUTH_CACHE_NEGATIVE_TTL_S
+        if epoch == self.epoch and ttl > 0:
+            self.entries[token] = (time.monotonic() + ttl, resp)
+            self.entries.move_to_end(token)
+            while len(self.entries) > AUTH_CACHE_MAX_ENTRIES:
+                self.entries.popitem(last=False)
+        return resp
+
+    def _reset(self, subscribed: bool):
+        self.entries.clear()
+        self.epoch += 1
+        self.subscribed = subscribed
+
+    async def _watch(self):
+        while True:
+            try:
+                async for event in self.stub.WatchRevocations(api_pb2.WatchRevocationsRequest(), wait_for_ready=True):
+                    if not event.token:
+                        self._reset(subscribed=True)
+                        continue
+                    self.entries.pop(event.token, None)
+                    self.epoch += 1
+                    self.revoked += 1
+            except grpc.aio.AioRpcError:
+                pass
+            self._reset(subscribed=False)
+            self.reconnects += 1
+            await asyncio.sleep(WATCH_RETRY_S)
+
+    async def _report(self):
+        last = None
+        while True:
+            await asyncio.sleep(AUTH_CACHE_STATS_S)
+            lookups = self.hits + self.negative_hits + self.misses
+            if lookups != last:
+                print(f"auth cache: {self.stats()}", flush=True)
+                last = lookups
+
+    async def close(self):
+        self.watch_task.cancel()
+        if self.report_task is not None:
+            self.report_task.cancel()
+        await self.channel.close()
+
+    def stats(self) -> dict:
+        return {"entries": len(self.entries), "subscribed": self.subscribed, "hits": self.hits,
+                "negative_hits": self.negative_hits, "misses": self.misses,
+                "revoked": self.revoked, "reconnects": self.reconnects}
@@ -0,0 +1,141 @@
+"""SQLite access for the grpc.aio services.
+
+The database runs in WAL mode. Reads use one connection per thread of a small
+read pool (``DB_READ_THREADS``) and run alongside writes. Every write goes
+through a single writer thread that group-commits: it takes all queued
+statements, waits up to ``DB_BATCH_MS`` after the oldest was queued for more
+(at most ``DB_BATCH_MAX``), and runs them in one transaction with
+``synchronous=FULL``. So there is one fsync per batch, not one per RPC. The
+wait is skipped while the previous batch was a single write, so a lightly
+loaded service commits at once.
+``execute()`` returns only once its batch has committed.
+
+Each statement runs under its own savepoint, so one failing insert (e.g. a
+UNIQUE violation) raises in its caller and does not abort the rest of the batch.
+"""
+from concurrent import futures
+import asyncio, os, queue, sqlite3, threading, time
+
+DB_BATCH_MS = float(os.environ.get("DB_BATCH_MS", "2"))
+DB_BATCH_MAX = int(os.environ.get("DB_BATCH_MAX", "256"))
+DB_READ_THREADS = int(os.environ.get("DB_READ_THREADS", "4"))
+DB_STREAM_CHUNK = int(os.environ.get("DB_STREAM_CHUNK", "500"))
+
+
+def _resolve(fut: asyncio.Future, result, exc):
+    if fut.done():  # caller was cancelled; the write still happened
+        return
+    if exc is not None:
+        fut.set_exception(exc)
+    else:
+        fut.set_result(result)
+
+
+class Database:
+    def __init__(self, path: str, schema: str):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.writer = self._connect()
+        self.writer.execute("PRAGMA synchronous=FULL")
+        self.writer.executescript(schema)
+        self.local = threading.local()
+        self.readers = futures.ThreadPoolExecutor(max_workers=DB_READ_THREADS, thread_name_prefix="db-read")
+        self.pending = queue.Queue()  # (enqueued_at, sql, params, loop, future)
+        self.commits = 0
+        self.writes = 0
+        self.last_batch = 0
+        threading.Thread(target=self._write_loop, name="db-writer", daemon=True).start()
+
+    def _connect(self) -> sqlite3.Connection:
+        # autocommit: transactions are opened explicitly by the writer
+        conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def _reader(self) -> sqlite3.Connection:
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.local.conn = self._connect()
+        return conn
+
+    # ---- reads ----
+    async def fetchone(self, sql: str, params=()):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.readers, lambda: self._reader().execute(sql, params).fetchone())
+
+    async def fetchall(self, sql: str, params=()):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.readers, lambda: self._reader().execute(sql, params).fetchall())
+
+    async def iterate(self, sql: str, params=(), after: int = 0, chunk: int = DB_STREAM_CHUNK):
+        """Yield the rows of a keyset query a chunk at a time.
+
+        `sql` selects the key (e.g. rowid) first and ends with
+        "key > ? ORDER BY key LIMIT ?"; `params` fill the placeholders before
+        those two. Each chunk is its own short read, so a long listing keeps
+        no read transaction open and holds at most `chunk` rows.
+        """
+        while True:
+            rows = await self.fetchall(sql, (*params, after, chunk))
+            for row in rows:
+                yield row
+            if len(rows) < chunk:
+                return
+            after = rows[-1][0]
+
+    # ---- writes ----
+    async def execute(self, sql: str, params=()) -> int:
+        """Run a write in the next group commit; returns its rowcount once durable."""
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self.pending.put((time.monotonic(), sql, params, loop, fut))
+        return await fut
+
+    def _next_batch(self):
+        batch = [self.pending.get()]
+        window = DB_BATCH_MS / 1000.0 if self.last_batch > 1 else 0.0
+        deadline = batch[0][0] + window
+        while len(batch) < DB_BATCH_MAX:
+            try:
+                batch.append(self.pending.get_nowait())
+                continue
+            except queue.Empty:
+                pass
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.pending.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _write_loop(self):
+        db = self.writer
+        while True:
+            batch = self._next_batch()
+            self.last_batch = len(batch)
+            results = []
+            try:
+                db.execute("BEGIN IMMEDIATE")
+                for _, sql, params, _, _ in batch:
+                    db.execute("SAVEPOINT w")
+                    try:
+                        results.append((db.execute(sql, params).rowcount, None))
+                        db.execute("RELEASE w")
+                    except sqlite3.Error as e:
+                        db.execute("ROLLBACK TO w")
+                        db.execute("RELEASE w")
+                        results.append((None, e))
+                db.execute("COMMIT")
+                self.commits += 1
+                self.writes += len(batch)
+            except sqlite3.Error as e:
+                if db.in_transaction:
+                    db.execute("ROLLBACK")
+                results = [(None, e)] * len(batch)
+            for (_, _, _, loop, fut), (result, exc) in zip(batch, results):
+                try:
+                    loop.call_soon_threadsafe(_resolve, fut, result, exc)
+                except RuntimeError:  # loop already closed at shutdown
+                    pass
@@ -1,61 +1,80 @@
-import os, sqlite3, uuid, grpc
-from concurrent import futures
+import asyncio, os, uuid, grpc
 
 import api_pb2, api_pb2_grpc
+from authcache import AuthCache
+from sqlitedb import Database
 
 AUTH_ADDR = os.environ.get("AUTH_ADDR", "auth:50051")
 DB_PATH = os.environ.get("DB_PATH", "/data/submission.db")
 PORT = os.environ.get("PORT", "50053")
+MAX_CONCURRENT_RPCS = int(os.environ.get("MAX_CONCURRENT_RPCS", "256"))  # beyond this, calls fail with RESOURCE_EXHAUSTED
+DEFAULT_PAGE_SIZE = int(os.environ.get("DEFAULT_PAGE_SIZE", "100"))
+MAX_PAGE_SIZE = int(os.environ.get("MAX_PAGE_SIZE", "1000"))
 
 os.makedirs("/data", exist_ok=True)
 
-def get_db():
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-    conn.execute("""
-    CREATE TABLE IF NOT EXISTS submissions(
-        id TEXT PRIMARY KEY,
-        challenge_id TEXT,
-        user_id TEXT,
-        artifact TEXT
-    );
-    """)
-    conn.commit()
-    return conn
-
-db = get_db()
-
-def validate_token(token: str):
-    with grpc.insecure_channel(AUTH_ADDR) as ch:
-        stub = api_pb2_grpc.AuthServiceStub(ch)
-        resp = stub.ValidateToken(api_pb2.ValidateTokenRequest(token=token))
-        return resp
+db = Database(DB_PATH, """
+CREATE TABLE IF NOT EXISTS submissions(
+    id TEXT PRIMARY KEY,
+    challenge_id TEXT,
+    user_id TEXT,
+    artifact TEXT
+);
+-- an index on challenge_id also orders each challenge's entries by rowid, which is what paging walks
+CREATE INDEX IF NOT EXISTS submissions_challenge ON submissions(challenge_id);
+""")
+
+# rows are paged by rowid, i.e. in insertion order; the page token is the last rowid returned
+BY_CHALLENGE = ("SELECT rowid, id, challenge_id, user_id, artifact FROM submissions "
+                "WHERE challenge_id = ? AND rowid > ? ORDER BY rowid LIMIT ?")
+
+def to_submission(r):
+    return api_pb2.Submission(id=r[1], challenge_id=r[2], user_id=r[3], artifact=r[4])
+
+async def page_args(request, context):
+    try:
+        after = int(request.page_token) if request.page_token else 0
+    except ValueError:
+        await context.abort(grpc.StatusCode.INVALID_ARGUMENT, "bad page_token")
+    return after, min(request.page_size if request.page_size > 0 else DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
 
 class SubmissionService(api_pb2_grpc.SubmissionServiceServicer):
-    def SubmitModel(self, request, context):
-        v = validate_token(request.token)
+    def __init__(self, auth: AuthCache):
+        self.auth = auth
+
+    async def SubmitModel(self, request, context):
+        v = await self.auth.validate(request.token)
         if not v.ok:
             return api_pb2.SubmitModelResponse(ok=False, message="unauthorized")
         sid = str(uuid.uuid4())
-        db.execute("INSERT INTO submissions(id, challenge_id, user_id, artifact) VALUES(?,?,?,?)",
-                   (sid, request.challenge_id.strip(), v.user.id, request.artifact.strip()))
-        db.commit()
+        await db.execute("INSERT INTO submissions(id, challenge_id, user_id, artifact) VALUES(?,?,?,?)",
+                         (sid, request.challenge_id.strip(), v.user.id, request.artifact.strip()))
         sub = api_pb2.Submission(id=sid, challenge_id=request.challenge_id.strip(),
                                  user_id=v.user.id, artifact=request.artifact.strip())
         return api_pb2.SubmitModelResponse(ok=True, message="submitted", submission=sub)
 
-    def ListSubmissions(self, request, context):
-        rows = db.execute("SELECT id, challenge_id, user_id, artifact FROM submissions WHERE challenge_id=?",
-                          (request.challenge_id.strip(),)).fetchall()
-        items = [api_pb2.Submission(id=r[0], challenge_id=r[1], user_id=r[2], artifact=r[3]) for r in rows]
-        return api_pb2.ListSubmissionsResponse(items=items)
+    async def ListSubmissions(self, request, context):
+        after, size = await page_args(request, context)
+        rows = await db.fetchall(BY_CHALLENGE, (request.challenge_id.strip(), after, size + 1))
+        next_token = str(rows[size - 1][0]) if len(rows) > size else ""
+        return api_pb2.ListSubmissionsResponse(items=[to_submission(r) for r in rows[:size]], next_page_token=next_token)
+
+    async def StreamSubmissions(self, request, context):
+        after, _ = await page_args(request, context)
+        async for r in db.iterate(BY_CHALLENGE, (request.challenge_id.strip(),), after=after):
+            yield to_submission(r)
 
-def serve():
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
-    api_pb2_grpc.add_SubmissionServiceServicer_to_server(SubmissionService(), server)
+async def serve():
+    server = grpc.aio.server(maximum_concurrent_rpcs=MAX_CONCURRENT_RPCS, options=[
+        # accept the gateway's keepalive pings on idle channels
+        ("grpc.keepalive_permit_without_calls", 1),
+        ("grpc.http2.min_recv_ping_interval_without_data_ms", 10000),
+    ])
+    api_pb2_grpc.add_SubmissionServiceServicer_to_server(SubmissionService(AuthCache(AUTH_ADDR)), server)
     server.add_insecure_port(f"[::]:{PORT}")
     print(f"SubmissionService listening on {PORT}")
-    server.start()
-    server.wait_for_termination()
+    await server.start()
+    await server.wait_for_termination()
 
 if __name__ == "__main__":
-    serve()
+    asyncio.run(serve())
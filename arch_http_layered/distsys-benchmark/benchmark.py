@@ -41,11 +41,13 @@ def load_yaml(path):
 
 
 # ------------------------------------------------------------
-async def one_request(session, url, json_body, timeout_s, method="POST"):
+async def one_request(session, url, json_body, timeout_s, method="POST", trace_id=None):
+    # the services record their spans under X-Trace-Id; trace_breakdown.py joins them back on req_id
+    headers = {"X-Trace-Id": trace_id} if trace_id else None
     t0 = time.perf_counter()
     try:
         if method.upper() == "GET":
-            async with session.get(url, timeout=timeout_s) as resp:
+            async with session.get(url, timeout=timeout_s, headers=headers) as resp:
                 _ = await resp.text()
                 t1 = time.perf_counter()
                 return {
@@ -54,7 +56,7 @@ async def one_request(session, url, json_body, timeout_s, method="POST"):
                     "latency_ms": (t1 - t0) * 1000.0,
                 }
         else:
-            async with session.post(url, json=json_body, timeout=timeout_s) as resp:
+            async with session.post(url, json=json_body, timeout=timeout_s, headers=headers) as resp:
                 _ = await resp.text()
                 t1 = time.perf_counter()
                 return {
@@ -76,7 +78,7 @@ async def run_level(session, url, json_body, timeout_s, concurrency, total_reque
     async def worker(req_id):
         nonlocal ok_count
         async with sem:
-            res = await one_request(session, url, json_body, timeout_s, method)
+            res = await one_request(session, url, json_body, timeout_s, method, trace_id=req_id)
             latencies.append(res["latency_ms"])
             if res["ok"]:
                 ok_count += 1
@@ -114,7 +116,9 @@ async def main():
     import argparse
     ap = argparse.ArgumentParser()
     ap.add_argument("-c", "--config", default="config.yaml")
+    ap.add_argument("--tag", default="", help="suffix for output files, e.g. w4 when comparing worker counts")
     args = ap.parse_args()
+    suffix = f"_{args.tag}" if args.tag else ""
 
     cfg = load_yaml(args.config)
     outdir = cfg.get("output_dir", "./bench_runs")
@@ -136,8 +140,8 @@ async def main():
 
             print(f"[run:{name}] -> {url} ({method})")
 
-            raw_path = os.path.join(outdir, f"{name}_raw.csv")
-            summary_path = os.path.join(outdir, f"{name}_summary.csv")
+            raw_path = os.path.join(outdir, f"{name}{suffix}_raw.csv")
+            summary_path = os.path.join(outdir, f"{name}{suffix}_summary.csv")
 
             with open(raw_path, "w", newline="") as fraw:
                 writer = csv.DictWriter(fraw, fieldnames=["run_label", "concurrency", "req_id", "ok", "status", "latency_ms"])
@@ -165,7 +169,7 @@ async def main():
             all_rows.extend(summaries)
 
         # 合并写入总汇
-        combined_path = os.path.join(outdir, "combined_summary.csv")
+        combined_path = os.path.join(outdir, f"combined_summary{suffix}.csv")
         with open(combined_path, "w", newline="") as f:
             w = csv.DictWriter(f, fieldnames=[
                 "run_label", "concurrency", "requests", "ok", "errors",
@@ -175,7 +179,7 @@ async def main():
             w.writeheader()
             for s in all_rows:
                 w.writerow(s)
-        print(f"\n✅ [saved] combined_summary.csv -> {combined_path}")
+        print(f"\n✅ [saved] combined_summary{suffix}.csv -> {combined_path}")
 
 
 # ------------------------------------------------------------
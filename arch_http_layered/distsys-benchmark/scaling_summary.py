@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""
+scaling_summary.py
+Compares benchmark.py results across uvicorn worker counts.
+Reads combined_summary_w<N>.csv files (written by `benchmark.py --tag w<N>`), prints peak
+throughput and the p95 at that level for each run and worker count, plus the speed-up over
+the smallest worker count, and writes scaling_summary.csv next to the inputs.
+"""
+
+import argparse
+import csv
+import os
+import re
+
+
+# ------------------------------------------------------------
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("summaries", nargs="+", help="combined_summary_w<N>.csv files")
+    args = ap.parse_args()
+
+    best = {}  # (run_label, workers) -> summary row with the highest throughput
+    for path in args.summaries:
+        m = re.search(r"_w(\d+)\.csv$", path)
+        if not m:
+            print(f"[skip] {path}: expected a name ending in _w<N>.csv")
+            continue
+        workers = int(m.group(1))
+        with open(path, newline="") as f:
+            for row in csv.DictReader(f):
+                key = (row["run_label"], workers)
+                if key not in best or float(row["throughput_rps"]) > float(best[key]["throughput_rps"]):
+                    best[key] = row
+
+    rows = []
+    for label in sorted({k[0] for k in best}):
+        counts = sorted(w for l, w in best if l == label)
+        base = float(best[(label, counts[0])]["throughput_rps"]) or float("nan")
+        print(f"\n[run:{label}]")
+        print(f"  {'workers':>7} {'peak rps':>10} {'at conc':>8} {'p95 ms':>9} {'speed-up':>9}")
+        for w in counts:
+            r = best[(label, w)]
+            rps = float(r["throughput_rps"])
+            rows.append({"run_label": label, "workers": w, "peak_throughput_rps": round(rps, 2),
+                         "concurrency": r["concurrency"], "latency_p95_ms": round(float(r["latency_p95_ms"]), 2),
+                         "speedup": round(rps / base, 2)})
+            print(f"  {w:>7} {rps:>10.1f} {r['concurrency']:>8} {float(r['latency_p95_ms']):>9.1f} {rps / base:>8.2f}x")
+
+    if rows:
+        out = os.path.join(os.path.dirname(args.summaries[0]) or ".", "scaling_summary.csv")
+        with open(out, "w", newline="") as f:
+            w = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+            w.writeheader()
+            w.writerows(rows)
+        print(f"\n✅ [saved] {out}")
+
+
+if __name__ == "__main__":
+    main()
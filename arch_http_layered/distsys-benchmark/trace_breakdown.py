@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+trace_breakdown.py
+Joins the spans the services wrote to TRACE_DIR (one JSONL file per service process)
+to a benchmark raw CSV on req_id == trace_id, and reports per-hop latency for each
+concurrency level.
+
+Hops are "<service>:<span name>", e.g. gateway:gateway.submit (server),
+gateway:call.scheduler (outbound call), scheduler:queue_wait, worker:inference.
+A hop seen several times in one request (retries) is summed for that request.
+Work a request only queued (worker/evaluator for /submit) shows up once the job
+ran, so let the stack drain before running this.
+
+Writes <raw>_hops.csv next to each raw CSV unless --out is given.
+"""
+
+import argparse
+import csv
+import glob
+import json
+import os
+from collections import defaultdict
+
+from benchmark import percentile
+
+
+# ------------------------------------------------------------
+def load_spans(trace_dir):
+    """trace_id -> {hop: summed dur_ms}"""
+    by_trace = defaultdict(lambda: defaultdict(float))
+    for path in glob.glob(os.path.join(trace_dir, "*.jsonl")):
+        with open(path) as f:
+            for line in f:
+                try:
+                    s = json.loads(line)
+                except ValueError:
+                    continue  # partial last line of a file still being written
+                by_trace[s["trace_id"]][f"{s['service']}:{s['name']}"] += s["dur_ms"]
+    return by_trace
+
+
+def breakdown(raw_path, spans):
+    # (run_label, concurrency) -> hop -> [ms per request]
+    levels = defaultdict(lambda: defaultdict(list))
+    with open(raw_path, newline="") as f:
+        for row in csv.DictReader(f):
+            hops = spans.get(row["req_id"])
+            if not hops:
+                continue
+            level = levels[(row["run_label"], int(row["concurrency"]))]
+            client_ms = float(row["latency_ms"])
+            level["client:total"].append(client_ms)
+            edge = [v for k, v in hops.items() if k.startswith("gateway:gateway.")]
+            if edge:
+                # time outside the gateway handler: client, network, accept queue
+                level["client:outside_gateway"].append(client_ms - max(edge))
+            for hop, ms in hops.items():
+                level[hop].append(ms)
+
+    rows = []
+    for (label, conc), hops in sorted(levels.items()):
+        total = hops["client:total"]
+        mean_total = sum(total) / len(total)
+        for hop, vals in sorted(hops.items(), key=lambda kv: -sum(kv[1]) / len(kv[1])):
+            avg = sum(vals) / len(vals)
+            rows.append({
+                "run_label": label,
+                "concurrency": conc,
+                "hop": hop,
+                "requests": len(vals),
+                "avg_ms": round(avg, 3),
+                "p50_ms": round(percentile(vals, 50), 3),
+                "p95_ms": round(percentile(vals, 95), 3),
+                "share_of_client": round(avg * len(vals) / (mean_total * len(total)), 3),
+            })
+    return rows
+
+
+# ------------------------------------------------------------
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--raw", nargs="+", required=True, help="raw CSV(s) written by benchmark.py")
+    ap.add_argument("--traces", default="../traces", help="TRACE_DIR mounted from the services")
+    ap.add_argument("--out", default=None, help="output CSV (only with a single --raw)")
+    args = ap.parse_args()
+
+    spans = load_spans(args.traces)
+    print(f"[traces] {len(spans)} traces from {args.traces}")
+
+    for raw_path in args.raw:
+        rows = breakdown(raw_path, spans)
+        if not rows:
+            print(f"[{raw_path}] no request matched a trace; was the stack started with TRACE_DIR?")
+            continue
+        out = args.out if args.out and len(args.raw) == 1 else raw_path.replace("_raw.csv", "") + "_hops.csv"
+        with open(out, "w", newline="") as f:
+            w = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+            w.writeheader()
+            w.writerows(rows)
+
+        current = None
+        for r in rows:
+            if (r["run_label"], r["concurrency"]) != current:
+                current = (r["run_label"], r["concurrency"])
+                print(f"\n[run:{current[0]}] concurrency={current[1]}")
+                print(f"  {'hop':<40} {'n':>6} {'avg ms':>9} {'p50 ms':>9} {'p95 ms':>9} {'share':>6}")
+            print(f"  {r['hop']:<40} {r['requests']:>6} {r['avg_ms']:>9.2f} {r['p50_ms']:>9.2f} "
+                  f"{r['p95_ms']:>9.2f} {r['share_of_client']:>6.2f}")
+        print(f"\n✅ [saved] {out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,13 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import Response, StreamingResponse
 from pydantic import BaseModel
-import os, requests
+from contextlib import asynccontextmanager
+from collections import OrderedDict
+from typing import Awaitable, Callable, List, Optional, Union
+import asyncio, json, os, time, httpx
+
+from common.tokens import TokenSigner, TokenError
+from common.tracing import TracingMiddleware, span, trace_headers
 
 AUTH_URL = os.getenv("AUTH_URL", "http://auth:8000")
 CHALLENGE_URL = os.getenv("CHALLENGE_URL", "http://challenge:8001")
@@ -8,12 +15,268 @@ SCHEDULER_URL = os.getenv("SCHEDULER_URL", "http://scheduler:8002")
 EVALUATOR_URL = os.getenv("EVALUATOR_URL", "http://evaluator:8004")
 LEADERBOARD_URL = os.getenv("LEADERBOARD_URL", "http://leaderboard:8005")
 
-app = FastAPI(title="API Gateway (HTTP)")
+# Defaults for every upstream pool; override per upstream with e.g. SCHEDULER_MAX_CONNECTIONS / SCHEDULER_TIMEOUT_S.
+UPSTREAM_MAX_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", "100"))
+UPSTREAM_TIMEOUT_S = float(os.getenv("UPSTREAM_TIMEOUT_S", "10"))
+UPSTREAM_POOL_TIMEOUT_S = float(os.getenv("UPSTREAM_POOL_TIMEOUT_S", "2"))
+REVOCATION_SYNC_S = float(os.getenv("REVOCATION_SYNC_S", "5"))
+FEED_TOP_K = int(os.getenv("FEED_TOP_K", "100"))  # depth of the leaderboard feed; larger stream k are capped
+SSE_PING_S = float(os.getenv("SSE_PING_S", "15"))
+# Read cache for hot GETs; a TTL of 0 turns caching off for that route group
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+CACHE_TTL_LEADERBOARD_S = float(os.getenv("CACHE_TTL_LEADERBOARD_S", "1"))
+CACHE_TTL_CHALLENGE_LIST_S = float(os.getenv("CACHE_TTL_CHALLENGE_LIST_S", "5"))
+
+UPSTREAMS = {
+    "auth": AUTH_URL,
+    "challenge": CHALLENGE_URL,
+    "scheduler": SCHEDULER_URL,
+    "evaluator": EVALUATOR_URL,
+    "leaderboard": LEADERBOARD_URL,
+}
+
+CLIENTS = {}  # upstream name -> httpx.AsyncClient with its own keep-alive pool
+SIGNER = TokenSigner()  # verifies tokens in-process; needs the same TOKEN_KEYS as auth
+
+
+def _make_client(name: str, base_url: str) -> httpx.AsyncClient:
+    max_conn = int(os.getenv(f"{name.upper()}_MAX_CONNECTIONS", UPSTREAM_MAX_CONNECTIONS))
+    timeout = float(os.getenv(f"{name.upper()}_TIMEOUT_S", UPSTREAM_TIMEOUT_S))
+    # max_connections caps concurrent requests to this upstream; extra callers wait up to the pool timeout
+    return httpx.AsyncClient(
+        base_url=base_url,
+        limits=httpx.Limits(max_connections=max_conn, max_keepalive_connections=max_conn),
+        timeout=httpx.Timeout(timeout, pool=UPSTREAM_POOL_TIMEOUT_S),
+    )
+
+
+async def _sync_revocations():
+    # Pull tokens revoked via /logout so locally verified tokens can still be cut off.
+    since = 0
+    while True:
+        try:
+            body = (await CLIENTS["auth"].get("/revocations", params={"since": since})).json()
+            if body["seq"] < since:
+                # auth restarted and its revocation list started over
+                SIGNER.revoked.clear()
+                since = 0
+                continue
+            SIGNER.merge_revocations(body["revoked"])
+            since = body["seq"]
+        except Exception:
+            pass
+        await asyncio.sleep(REVOCATION_SYNC_S)
+
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def _delta(old: list, new: list) -> dict:
+    before = {e["submission_id"]: (i, e["score"]) for i, e in enumerate(old)}
+    after = {e["submission_id"] for e in new}
+    return {"upserted": [{"rank": i + 1, **e} for i, e in enumerate(new) if before.get(e["submission_id"]) != (i, e["score"])],
+            "removed": [sid for sid in before if sid not in after]}
+
+
+class _Subscriber:
+    __slots__ = ("challenge_id", "k", "event")
+
+    def __init__(self, challenge_id: str, k: int):
+        self.challenge_id = challenge_id
+        self.k = k
+        self.event = asyncio.Event()
+
+
+class LeaderboardFanout:
+    """Shares one upstream leaderboard /feed among every SSE subscriber on this gateway.
+
+    Only the latest top per challenge is kept; each subscriber is woken and diffs against what it last
+    sent, so a slow client skips intermediate states instead of building a backlog. Every feed event also
+    drops the challenge's cached leaderboard reads: it marks the moment a score actually landed.
+    """
+
+    def __init__(self):
+        self.latest = {}  # challenge_id -> top FEED_TOP_K entries, only for challenges someone watches
+        self.subs = {}  # challenge_id -> set of _Subscriber
+
+    def subscribe(self, challenge_id: str, k: int) -> _Subscriber:
+        sub = _Subscriber(challenge_id, k)
+        self.subs.setdefault(challenge_id, set()).add(sub)
+        return sub
+
+    def unsubscribe(self, sub: _Subscriber):
+        subs = self.subs.get(sub.challenge_id)
+        if subs is not None:
+            subs.discard(sub)
+            if not subs:
+                del self.subs[sub.challenge_id]
+                self.latest.pop(sub.challenge_id, None)
+
+    def publish(self, challenge_id: str, top: list):
+        if challenge_id not in self.subs:
+            return
+        self.latest[challenge_id] = top
+        for sub in self.subs[challenge_id]:
+            sub.event.set()
+
+    async def fetch(self, challenge_id: str):
+        r = await _call("leaderboard", "GET", f"/top/{challenge_id}", params={"k": FEED_TOP_K})
+        self.publish(challenge_id, r.json())
+
+    async def run(self):
+        while True:
+            try:
+                async with CLIENTS["leaderboard"].stream("GET", "/feed", timeout=httpx.Timeout(UPSTREAM_TIMEOUT_S, read=3 * SSE_PING_S)) as r:
+                    r.raise_for_status()
+                    # anything that changed while we were disconnected
+                    CACHE.invalidate("leaderboard")
+                    for cid in list(self.subs):
+                        await self.fetch(cid)
+                    data = []
+                    async for line in r.aiter_lines():
+                        if line.startswith("data:"):
+                            data.append(line[5:].strip())
+                        elif not line and data:
+                            msg = json.loads("\n".join(data))
+                            data = []
+                            CACHE.invalidate("leaderboard", msg["challenge_id"])
+                            self.publish(msg["challenge_id"], msg["top"])
+            except Exception:
+                pass
+            await asyncio.sleep(1.0)
+
+    async def stream(self, sub: _Subscriber):
+        sent = None
+        try:
+            while True:
+                sub.event.clear()
+                top = self.latest.get(sub.challenge_id, [])[:sub.k]
+                if sent is None:
+                    yield _sse("snapshot", {"challenge_id": sub.challenge_id, "top": top})
+                elif top != sent:
+                    yield _sse("delta", {"challenge_id": sub.challenge_id, **_delta(sent, top)})
+                sent = top
+                try:
+                    await asyncio.wait_for(sub.event.wait(), SSE_PING_S)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+        finally:
+            self.unsubscribe(sub)
+
+
+FANOUT = LeaderboardFanout()
+
+class _Cached:
+    __slots__ = ("expires", "status", "etag", "body")
+
+    def __init__(self, expires: float, status: int, etag: Optional[str], body: bytes):
+        self.expires = expires
+        self.status = status
+        self.etag = etag
+        self.body = body
+
+
+class ReadCache:
+    """Upstream GET responses kept for a short TTL, LRU-bounded by body size.
+
+    Keys are tuples that start with (upstream, scope), e.g. ("leaderboard", cid, "/top", k), so a write can
+    drop every entry under a prefix. Concurrent misses for one key share a single upstream call.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> _Cached, least recently used first
+        self.inflight = {}  # key -> asyncio.Task fetching it
+        self.bytes = 0
+        self.epoch = 0  # bumped by invalidate(); fetches started before it don't get stored
+        self.stats = {"hits": 0, "misses": 0, "coalesced": 0, "evictions": 0, "invalidations": 0}
+
+    def _drop(self, key):
+        self.bytes -= len(self.entries.pop(key).body)
+
+    async def get(self, key: tuple, ttl: float, fetch: Callable[[], Awaitable[httpx.Response]]) -> _Cached:
+        e = self.entries.get(key)
+        if e is not None:
+            if e.expires > time.monotonic():
+                self.stats["hits"] += 1
+                self.entries.move_to_end(key)
+                return e
+            self._drop(key)
+        task = self.inflight.get(key)
+        if task is not None:
+            self.stats["coalesced"] += 1
+        else:
+            self.stats["misses"] += 1
+            # a task of its own, so a caller that disconnects doesn't cancel the fetch for everyone else
+            task = self.inflight[key] = asyncio.ensure_future(self._fill(key, ttl, fetch))
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        return await asyncio.shield(task)
+
+    async def _fill(self, key: tuple, ttl: float, fetch) -> _Cached:
+        epoch = self.epoch
+        try:
+            r = await fetch()
+        finally:
+            del self.inflight[key]
+        e = _Cached(time.monotonic() + ttl, r.status_code, r.headers.get("etag"), r.content)
+        if r.status_code == 200 and ttl > 0 and epoch == self.epoch and len(e.body) <= self.max_bytes:
+            self.entries[key] = e
+            self.bytes += len(e.body)
+            while self.bytes > self.max_bytes:
+                self._drop(next(iter(self.entries)))
+                self.stats["evictions"] += 1
+        return e
+
+    def invalidate(self, *prefix):
+        self.epoch += 1
+        self.stats["invalidations"] += 1
+        for key in [k for k in self.entries if k[:len(prefix)] == prefix]:
+            self._drop(key)
+
+
+CACHE = ReadCache(CACHE_MAX_BYTES)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    for name, url in UPSTREAMS.items():
+        CLIENTS[name] = _make_client(name, url)
+    sync = asyncio.create_task(_sync_revocations())
+    feed = asyncio.create_task(FANOUT.run())
+    yield
+    feed.cancel()
+    sync.cancel()
+    for c in CLIENTS.values():
+        await c.aclose()
+    CLIENTS.clear()
+
+
+app = FastAPI(title="API Gateway (HTTP)", lifespan=lifespan)
+app.add_middleware(TracingMiddleware, service="gateway")
+
+
+async def _call(upstream: str, method: str, path: str, **kw) -> httpx.Response:
+    tracing = trace_headers()
+    if tracing:
+        kw["headers"] = {**kw.get("headers", {}), **tracing}
+    try:
+        with span(f"call.{upstream}", kind="client", path=path):
+            return await CLIENTS[upstream].request(method, path, **kw)
+    except httpx.PoolTimeout:
+        raise HTTPException(503, f"{upstream} busy", headers={"Retry-After": "1"})
+    except httpx.TimeoutException:
+        raise HTTPException(504, f"{upstream} timed out")
+    except httpx.TransportError as e:
+        raise HTTPException(502, f"{upstream} unreachable: {e}")
 
 class Register(BaseModel):
     username: str
     password: str
 
+class Logout(BaseModel):
+    token: str
+
 class Submit(BaseModel):
     token: str
     challenge_id: str
@@ -22,43 +285,115 @@ class Submit(BaseModel):
 class Evaluate(BaseModel):
     submission_id: str
     challenge_id: str
-    pred: float
+    pred: Union[float, List[float], None] = None
+    pred_b64: Optional[str] = None
 
 @app.post("/register")
-def register(r: Register):
-    return requests.post(f"{AUTH_URL}/register", json=r.model_dump()).json()
+async def register(r: Register):
+    return (await _call("auth", "POST", "/register", json=r.model_dump())).json()
 
 @app.post("/login")
-def login(r: Register):
-    return requests.post(f"{AUTH_URL}/login", json=r.model_dump()).json()
+async def login(r: Register):
+    return (await _call("auth", "POST", "/login", json=r.model_dump())).json()
+
+@app.post("/logout")
+async def logout(r: Logout):
+    resp = await _call("auth", "POST", "/logout", json=r.model_dump())
+    if resp.status_code != 200:
+        raise HTTPException(resp.status_code, resp.json().get("detail"))
+    try:
+        claims = SIGNER.verify(r.token)
+    except TokenError:  # a revocation sync during the call already merged it (or it just expired)
+        return resp.json()
+    SIGNER.revoke(claims["jti"], claims["exp"])  # don't wait for the next sync on this replica
+    return resp.json()
+
+def _cached_get(key: tuple, ttl: float, upstream: str, path: str, params: Optional[dict] = None) -> Awaitable[_Cached]:
+    return CACHE.get(key, ttl, lambda: _call(upstream, "GET", path, params=params))
 
 @app.post("/challenge/create")
-def create_challenge(c: dict):
-    return requests.post(f"{CHALLENGE_URL}/create", json=c).json()
+async def create_challenge(c: dict):
+    r = await _call("challenge", "POST", "/create", json=c)
+    CACHE.invalidate("challenge")
+    return r.json()
 
 @app.get("/challenge/list")
-def list_challenges():
-    return requests.get(f"{CHALLENGE_URL}/list").json()
+async def list_challenges(request: Request, cursor: Optional[str] = None, limit: Optional[int] = None):
+    # Cached unconditionally; If-None-Match is answered here against the cached ETag
+    params = {k: v for k, v in {"cursor": cursor, "limit": limit}.items() if v is not None}
+    e = await _cached_get(("challenge", "list", cursor, limit), CACHE_TTL_CHALLENGE_LIST_S, "challenge", "/list", params)
+    out_headers = {"ETag": e.etag} if e.etag else {}
+    inm = request.headers.get("if-none-match")
+    if e.etag and inm and any(t.strip() in ("*", e.etag, f"W/{e.etag}") for t in inm.split(",")):
+        return Response(status_code=304, headers=out_headers)
+    return Response(e.body, status_code=e.status, media_type="application/json", headers=out_headers)
 
 @app.post("/submit")
-def submit(s: Submit):
-    # verify token (simple pass-through)
-    v = requests.get(f"{AUTH_URL}/verify", params={"token": s.token})
-    if v.status_code != 200:
-        raise HTTPException(401, "invalid token")
-    return requests.post(f"{SCHEDULER_URL}/submit", json=s.model_dump()).json()
+async def submit(s: Submit):
+    try:
+        with span("verify_token"):
+            SIGNER.verify(s.token)
+    except TokenError as e:
+        raise HTTPException(401, f"invalid token: {e}")
+    r = await _call("scheduler", "POST", "/submit", json=s.model_dump())
+    if r.status_code == 429:
+        # scheduler queue is full; let the client back off
+        raise HTTPException(429, "scheduler queue full", headers={"Retry-After": r.headers.get("Retry-After", "1")})
+    return r.json()
 
 @app.post("/evaluate")
-def evaluate(e: Evaluate):
+async def evaluate(e: Evaluate):
     """
     转发评估请求到 evaluator 服务。
     evaluator 接收 submission_id, challenge_id, pred (可选)
     """
-    resp = requests.post(f"{EVALUATOR_URL}/evaluate", json=e.model_dump())
+    # the score reaches the leaderboard later (evaluator outbox); its /feed event invalidates the cache
+    resp = await _call("evaluator", "POST", "/evaluate", json=e.model_dump(exclude_none=True))
     if resp.status_code != 200:
         raise HTTPException(resp.status_code, f"Evaluator error: {resp.text}")
     return resp.json()
 
+def _relay(e: _Cached) -> Response:
+    if e.status != 200:
+        raise HTTPException(e.status, json.loads(e.body).get("detail"))
+    return Response(e.body, media_type="application/json")
+
 @app.get("/leaderboard/{challenge_id}")
-def leaderboard(challenge_id: str, k: int = 10):
-    return requests.get(f"{LEADERBOARD_URL}/top/{challenge_id}", params={"k": k}).json()
+async def leaderboard(challenge_id: str, k: int = 10):
+    return _relay(await _cached_get(("leaderboard", challenge_id, "top", k), CACHE_TTL_LEADERBOARD_S,
+                                    "leaderboard", f"/top/{challenge_id}", {"k": k}))
+
+@app.get("/leaderboard/{challenge_id}/stream")
+async def leaderboard_stream(challenge_id: str, k: int = 10):
+    """SSE: a `snapshot` of the top k, then a `delta` (upserted ranks, removed ids) whenever it changes."""
+    sub = FANOUT.subscribe(challenge_id, max(1, min(k, FEED_TOP_K)))
+    if challenge_id not in FANOUT.latest:
+        try:
+            await FANOUT.fetch(challenge_id)
+        except HTTPException:
+            FANOUT.unsubscribe(sub)
+            raise
+    return StreamingResponse(FANOUT.stream(sub), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@app.get("/leaderboard/{challenge_id}/rank/{submission_id}")
+async def leaderboard_rank(challenge_id: str, submission_id: str):
+    r = await _call("leaderboard", "GET", f"/rank/{challenge_id}/{submission_id}")
+    if r.status_code != 200:
+        raise HTTPException(r.status_code, r.json().get("detail"))
+    return r.json()
+
+@app.get("/leaderboard/{challenge_id}/page")
+async def leaderboard_page(challenge_id: str, offset: int = 0, limit: int = 50):
+    return _relay(await _cached_get(("leaderboard", challenge_id, "page", offset, limit), CACHE_TTL_LEADERBOARD_S,
+                                    "leaderboard", f"/page/{challenge_id}", {"offset": offset, "limit": limit}))
+
+@app.get("/leaderboard/{challenge_id}/range")
+async def leaderboard_range(challenge_id: str, min_score: Optional[float] = None, max_score: Optional[float] = None, limit: int = 100):
+    params = {k: v for k, v in {"min_score": min_score, "max_score": max_score, "limit": limit}.items() if v is not None}
+    return _relay(await _cached_get(("leaderboard", challenge_id, "range", min_score, max_score, limit), CACHE_TTL_LEADERBOARD_S,
+                                    "leaderboard", f"/range/{challenge_id}", params))
+
+@app.get("/cache/stats")
+async def cache_stats():
+    return {"entries": len(CACHE.entries), "bytes": CACHE.bytes, "max_bytes": CACHE.max_bytes,
+            "inflight": len(CACHE.inflight), **CACHE.stats}
@@ -1,11 +1,19 @@
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
-import uuid
+import uuid, time
+
+from common.store import open_store
+from common.tokens import TokenSigner, TokenError
+from common.tracing import TracingMiddleware
 
 app = FastAPI(title="Auth Service (HTTP)")
+app.add_middleware(TracingMiddleware, service="auth")
 
-USERS = {}  # username -> {"password":..., "id":...}
-TOKENS = {}  # token -> username
+# Shared by every uvicorn worker when STORE_URL is sqlite. Namespaces:
+#   users:       username -> {"password":..., "id":...}
+#   revocations: jti -> {"exp":...} for revoked, not yet expired tokens; its seq is the revocation seq
+STORE = open_store()
+SIGNER = TokenSigner()
 
 class RegisterReq(BaseModel):
     username: str
@@ -15,24 +23,53 @@ class LoginReq(BaseModel):
     username: str
     password: str
 
+class LogoutReq(BaseModel):
+    token: str
+
+def _revoked(jti: str) -> bool:
+    # another worker may have handled the /logout, so ask the store rather than SIGNER.revoked
+    return STORE.get("revocations", jti) is not None
+
 @app.post("/register")
 def register(r: RegisterReq):
-    if r.username in USERS:
+    if not STORE.insert("users", r.username, {"password": r.password, "id": str(uuid.uuid4())}):
         raise HTTPException(400, "user exists")
-    USERS[r.username] = {"password": r.password, "id": str(uuid.uuid4())}
     return {"status": "ok"}
 
 @app.post("/login")
 def login(r: LoginReq):
-    u = USERS.get(r.username)
+    u = STORE.get("users", r.username)
     if not u or u["password"] != r.password:
         raise HTTPException(401, "bad creds")
-    token = str(uuid.uuid4())
-    TOKENS[token] = r.username
-    return {"token": token}
+    return {"token": SIGNER.issue(r.username)}
+
+@app.post("/logout")
+def logout(r: LogoutReq):
+    try:
+        claims = SIGNER.verify(r.token)
+    except TokenError as e:
+        raise HTTPException(401, str(e))
+    if _revoked(claims["jti"]):
+        raise HTTPException(401, "token revoked")
+    now = time.time()
+    for _, jti, e in STORE.scan("revocations"):
+        if e["exp"] < now:
+            STORE.delete("revocations", jti)
+    STORE.put("revocations", claims["jti"], {"exp": claims["exp"]})
+    return {"status": "ok"}
+
+@app.get("/revocations")
+def revocations(since: int = 0):
+    # Verifiers poll this with the last seq they saw; a seq lower than theirs means we restarted.
+    seq = STORE.last_seq()
+    return {"seq": seq, "revoked": [{"jti": jti, "exp": e["exp"]} for s, jti, e in STORE.scan("revocations", after=since) if s <= seq]}
 
 @app.get("/verify")
 def verify(token: str):
-    if token not in TOKENS:
-        raise HTTPException(401, "invalid token")
-    return {"username": TOKENS[token]}
+    try:
+        claims = SIGNER.verify(token)
+    except TokenError as e:
+        raise HTTPException(401, str(e))
+    if _revoked(claims["jti"]):
+        raise HTTPException(401, "token revoked")
+    return {"username": claims["sub"]}
@@ -1,22 +1,67 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import Response
 from pydantic import BaseModel
-import uuid
+from typing import Optional
+import json, uuid
+
+from common.store import open_store
+from common.tracing import TracingMiddleware
 
 app = FastAPI(title="Challenge Service (HTTP)")
+app.add_middleware(TracingMiddleware, service="challenge")
 
-CHALLENGES = {}  # id -> info
+# Shared by every uvicorn worker when STORE_URL is sqlite. Namespace "challenges": id -> info, in
+# creation order; a page cursor is the store seq of the last challenge on the previous page.
+STORE = open_store()
+VERSION = "challenges.version"  # counter bumped on every change to the challenges, served as the ETag
+_list_cache = (None, None)  # (version, encoded full listing) built by this process
 
 class Challenge(BaseModel):
     title: str
     description: str
     deadline: str
 
+
+def _etag(version: int) -> str:
+    return f'"v{version}"'
+
+
+def _not_modified(request: Request, etag: str) -> bool:
+    inm = request.headers.get("if-none-match")
+    if not inm:
+        return False
+    tags = [t.strip() for t in inm.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+
 @app.post("/create")
 def create(c: Challenge):
     cid = str(uuid.uuid4())
-    CHALLENGES[cid] = c.model_dump()
+    STORE.put("challenges", cid, c.model_dump())
+    STORE.incr(VERSION)  # after the write, so a listing under the new version always includes it
     return {"challenge_id": cid}
 
 @app.get("/list")
-def list_challenges():
-    return CHALLENGES
+def list_challenges(request: Request, cursor: Optional[str] = None, limit: Optional[int] = None):
+    """Without cursor/limit: the whole {id: info} map, as before. With them: one page plus next_cursor."""
+    global _list_cache
+    version = STORE.counter(VERSION)
+    etag = _etag(version)
+    if _not_modified(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    if cursor is None and limit is None:
+        if _list_cache[0] != version:
+            _list_cache = (version, json.dumps({cid: info for _, cid, info in STORE.scan("challenges")}).encode())
+        body = _list_cache[1]
+    else:
+        try:
+            after = int(cursor or 0)
+        except ValueError:
+            after = -1
+        if after < 0:
+            raise HTTPException(400, "bad cursor")
+        n = max(1, min(limit or 100, 1000))
+        rows = STORE.scan("challenges", after=after, limit=n + 1)
+        items = [{"challenge_id": cid, **info} for _, cid, info in rows[:n]]
+        body = json.dumps({"items": items, "next_cursor": str(rows[n - 1][0]) if len(rows) > n else None}).encode()
+    return Response(body, media_type="application/json", headers={"ETag": etag})
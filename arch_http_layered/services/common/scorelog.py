@@ -0,0 +1,244 @@
+"""Durable leaderboard scores: an append-only log plus periodic snapshots.
+
+Files in the score directory, by generation ``G``:
+
+* ``scores-G.log``: one record per update, in order. A record is
+  ``crc32 | len(challenge) | len(submission) | score`` (``<IHHd``) followed by
+  both ids in UTF-8; the CRC covers everything after itself.
+* ``snapshot-G.bin``: every score as of the start of ``scores-G.log``:
+  ``LBS1 | challenges`` and, per challenge, ``len(id) | entries | id`` then
+  ``len(submission) | score | submission`` per entry, with a CRC32 of the
+  whole body at the end.
+
+``append()`` only buffers an encoded record, so it adds next to nothing to an
+update. A flusher thread writes and fsyncs the buffer every
+``SCORE_FSYNC_MS``; a crash loses at most that window. Once the log has grown
+by ``SCORE_SNAPSHOT_BYTES`` (or ``SCORE_SNAPSHOT_INTERVAL_S`` passed with
+updates), the flusher starts generation G+1, writes ``snapshot-(G+1)`` from
+the live state and drops files older than the previous snapshot. The state
+may already include updates logged in G+1; replaying those again is harmless
+because an update sets a score and the last one wins.
+
+``recover()`` loads the newest readable snapshot and replays the logs from
+its generation on, stopping at the first torn or corrupt record.
+
+A failed write or fsync cuts the log back to its last durable length and
+puts the records back in the buffer, so the next flush retries them; a failed
+snapshot is retried after another interval or ``SCORE_SNAPSHOT_BYTES``.
+Failures are logged and counted in ``stats`` (``errors``, ``last_error``).
+"""
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+import glob, logging, os, re, struct, threading, time, zlib
+
+SCORE_FSYNC_MS = float(os.getenv("SCORE_FSYNC_MS", "20"))
+SCORE_SNAPSHOT_BYTES = int(os.getenv("SCORE_SNAPSHOT_BYTES", str(64 * 1024 * 1024)))
+SCORE_SNAPSHOT_INTERVAL_S = float(os.getenv("SCORE_SNAPSHOT_INTERVAL_S", "300"))
+
+log = logging.getLogger("scorelog")
+
+_REC = struct.Struct("<IHHd")
+_SNAP_CHALLENGE = struct.Struct("<HI")
+_SNAP_ENTRY = struct.Struct("<Hd")
+_SNAP_MAGIC = b"LBS1"
+
+# challenge_id -> {submission_id: score}
+Scores = Dict[str, Dict[str, float]]
+
+
+def _encode(challenge_id: str, submission_id: str, score: float) -> bytes:
+    c, s = challenge_id.encode(), submission_id.encode()
+    body = _REC.pack(0, len(c), len(s), score)[4:] + c + s
+    return struct.pack("<I", zlib.crc32(body)) + body
+
+
+def _replay(path: str, scores: Scores) -> Tuple[int, int]:
+    """Apply a log's records to `scores`; returns (records, bytes) up to the first bad record."""
+    with open(path, "rb") as f:
+        data = f.read()
+    pos = n = 0
+    while pos + _REC.size <= len(data):
+        crc, clen, slen, score = _REC.unpack_from(data, pos)
+        end = pos + _REC.size + clen + slen
+        if end > len(data) or zlib.crc32(data[pos + 4:end]) != crc:
+            break
+        ids = data[pos + _REC.size:end]
+        scores.setdefault(ids[:clen].decode(), {})[ids[clen:].decode()] = score
+        pos, n = end, n + 1
+    return n, pos
+
+
+def _load_snapshot(path: str) -> Optional[Scores]:
+    with open(path, "rb") as f:
+        data = f.read()
+    if data[:4] != _SNAP_MAGIC or len(data) < 12:
+        return None
+    body, (crc,) = data[4:-4], struct.unpack("<I", data[-4:])
+    if zlib.crc32(body) != crc:
+        return None
+    scores = {}
+    (n_challenges,), pos = struct.unpack_from("<I", body), 4
+    for _ in range(n_challenges):
+        clen, n = _SNAP_CHALLENGE.unpack_from(body, pos)
+        pos += _SNAP_CHALLENGE.size
+        board = scores[body[pos:pos + clen].decode()] = {}
+        pos += clen
+        for _ in range(n):
+            slen, score = _SNAP_ENTRY.unpack_from(body, pos)
+            pos += _SNAP_ENTRY.size
+            board[body[pos:pos + slen].decode()] = score
+            pos += slen
+    return scores
+
+
+def _write_snapshot(path: str, state: Iterable[Tuple[str, Dict[str, float]]]):
+    parts = []
+    n_challenges = 0
+    for challenge_id, board in state:
+        c = challenge_id.encode()
+        parts.append(_SNAP_CHALLENGE.pack(len(c), len(board)) + c)
+        for submission_id, score in board.items():
+            s = submission_id.encode()
+            parts.append(_SNAP_ENTRY.pack(len(s), score) + s)
+        n_challenges += 1
+    body = struct.pack("<I", n_challenges) + b"".join(parts)
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(_SNAP_MAGIC + body + struct.pack("<I", zlib.crc32(body)))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def _generations(directory: str, kind: str) -> List[int]:
+    pattern = re.compile(rf"{kind}-(\d+)\.(?:log|bin)$")
+    return sorted(int(m.group(1)) for m in map(pattern.search, glob.glob(os.path.join(directory, f"{kind}-*")))
+                  if m)
+
+
+class ScoreLog:
+    """Score persistence for one leaderboard service.
+
+    `state()` returns (challenge_id, {submission_id: score}) pairs for a snapshot. It is called from the
+    flusher thread, so it must hand back copies the service will not mutate meanwhile.
+    """
+
+    def __init__(self, directory: str, state: Callable[[], Iterable[Tuple[str, Dict[str, float]]]]):
+        self.dir = directory
+        self.state = state
+        self.lock = threading.Lock()
+        self.buffer = []  # encoded records not yet written
+        self.gen = 0
+        self.file = None
+        self.log_bytes = 0  # bytes in the current generation's log
+        self.last_snapshot = time.monotonic()
+        self.stats = {"appended": 0, "fsyncs": 0, "snapshots": 0, "recovered": 0, "replayed": 0,
+                      "recovery_s": 0.0, "dropped_tail_bytes": 0, "errors": 0, "last_error": None}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _path(self, kind: str, gen: int) -> str:
+        return os.path.join(self.dir, f"{kind}-{gen}.{'log' if kind == 'scores' else 'bin'}")
+
+    def recover(self) -> Scores:
+        """Rebuild all scores from disk and open the log for appending; call once, before start()."""
+        t0 = time.perf_counter()
+        os.makedirs(self.dir, exist_ok=True)
+        scores, base = {}, 0
+        for gen in reversed(_generations(self.dir, "snapshot")):
+            loaded = _load_snapshot(self._path("snapshot", gen))
+            if loaded is not None:
+                scores, base = loaded, gen
+                break
+        self.stats["recovered"] = sum(len(b) for b in scores.values())
+        logs = [g for g in _generations(self.dir, "scores") if g >= base]
+        for gen in logs:
+            path = self._path("scores", gen)
+            n, good = _replay(path, scores)
+            self.stats["replayed"] += n
+            size = os.path.getsize(path)
+            if good < size:  # torn write at the crash point: keep what is intact
+                self.stats["dropped_tail_bytes"] += size - good
+                with open(path, "r+b") as f:
+                    f.truncate(good)
+        self.gen = logs[-1] if logs else base
+        path = self._path("scores", self.gen)
+        self.file = open(path, "ab", buffering=0)
+        self.log_bytes = os.path.getsize(path)
+        self.stats["recovery_s"] = round(time.perf_counter() - t0, 3)
+        return scores
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="score-log", daemon=True)
+        self._thread.start()
+
+    def append(self, challenge_id: str, submission_id: str, score: float):
+        rec = _encode(challenge_id, submission_id, score)
+        with self.lock:
+            self.buffer.append(rec)
+
+    def _flush(self, rotate: bool = False):
+        with self.lock:
+            pending, self.buffer = self.buffer, []
+            old, gen, size = self.file, self.gen, self.log_bytes
+            if rotate:
+                self.gen += 1
+                self.file = open(self._path("scores", self.gen), "ab", buffering=0)
+                self.log_bytes = 0
+        try:
+            if pending:
+                data = b"".join(pending)
+                try:
+                    view = memoryview(data)
+                    while view:
+                        view = view[old.write(view):]
+                    os.fsync(old.fileno())
+                except OSError:
+                    # drop a partial record so the retry appends after the last good one
+                    os.ftruncate(old.fileno(), size)
+                    with self.lock:
+                        self.buffer[:0] = pending
+                    raise
+                if not rotate:
+                    self.log_bytes += len(data)
+                self.stats["appended"] += len(pending)
+                self.stats["fsyncs"] += 1
+        finally:
+            if rotate:
+                old.close()
+        return gen
+
+    def snapshot(self):
+        """Start a new log generation and write the snapshot it starts from.
+
+        The previous snapshot and its logs are kept as a fallback in case the new one turns out unreadable;
+        anything older is removed.
+        """
+        prev = self._flush(rotate=True)
+        gen = prev + 1
+        _write_snapshot(self._path("snapshot", gen), self.state())
+        for kind in ("snapshot", "scores"):
+            for g in _generations(self.dir, kind):
+                if g < prev:
+                    os.remove(self._path(kind, g))
+        self.last_snapshot = time.monotonic()
+        self.stats["snapshots"] += 1
+
+    def _run(self):
+        while not self._stop.wait(SCORE_FSYNC_MS / 1000.0):
+            try:
+                self._flush()
+                due = time.monotonic() - self.last_snapshot >= SCORE_SNAPSHOT_INTERVAL_S and self.log_bytes > 0
+                if self.log_bytes >= SCORE_SNAPSHOT_BYTES or due:
+                    self.last_snapshot = time.monotonic()  # a failed snapshot waits a full interval to retry
+                    self.snapshot()
+            except Exception as e:
+                self.stats["errors"] += 1
+                self.stats["last_error"] = repr(e)
+                log.exception("score log flush failed; retrying")
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._flush()
+        self.file.close()
@@ -0,0 +1,189 @@
+"""Key-value state shared by the processes of one HTTP service.
+
+Records are JSON objects addressed by ``(namespace, key)``. Each insert gets
+a store-wide, increasing ``seq``, so a namespace can be listed in insertion
+order and paged with ``scan(ns, after=<last seq seen>)``. Named counters back
+version numbers such as an ETag.
+
+``open_store()`` picks the backend from ``STORE_URL``:
+
+* ``memory://`` (default): dicts in this process. Fine for one uvicorn
+  worker; with ``--workers N`` every worker would see its own state.
+* ``sqlite:///<path>``: one SQLite file in WAL mode. Any number of processes
+  on the host can share it, and it survives restarts.
+"""
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+import json, os, sqlite3, threading
+
+
+class Store(ABC):
+    @abstractmethod
+    def get(self, ns: str, key: str) -> Optional[dict]:
+        ...
+
+    @abstractmethod
+    def put(self, ns: str, key: str, value: dict):
+        """Insert or replace; a replaced record keeps its seq."""
+
+    @abstractmethod
+    def insert(self, ns: str, key: str, value: dict) -> bool:
+        """Insert only if the key is new; False if it already exists."""
+
+    @abstractmethod
+    def delete(self, ns: str, key: str):
+        ...
+
+    @abstractmethod
+    def scan(self, ns: str, after: int = 0, limit: Optional[int] = None) -> List[Tuple[int, str, dict]]:
+        """(seq, key, value) with seq > after, oldest first."""
+
+    @abstractmethod
+    def last_seq(self) -> int:
+        """Highest seq handed out so far, in any namespace."""
+
+    @abstractmethod
+    def incr(self, name: str, by: int = 1) -> int:
+        ...
+
+    @abstractmethod
+    def counter(self, name: str) -> int:
+        ...
+
+
+class MemoryStore(Store):
+    def __init__(self):
+        self.data = {}  # ns -> OrderedDict(key -> (seq, value)), in seq order
+        self.counters = {}
+        self.seq = 0
+        self.lock = threading.Lock()
+
+    def get(self, ns, key):
+        rec = self.data.get(ns, {}).get(key)
+        return rec[1] if rec else None
+
+    def put(self, ns, key, value):
+        with self.lock:
+            table = self.data.setdefault(ns, OrderedDict())
+            if key in table:
+                table[key] = (table[key][0], value)
+            else:
+                self.seq += 1
+                table[key] = (self.seq, value)
+
+    def insert(self, ns, key, value):
+        with self.lock:
+            table = self.data.setdefault(ns, OrderedDict())
+            if key in table:
+                return False
+            self.seq += 1
+            table[key] = (self.seq, value)
+            return True
+
+    def delete(self, ns, key):
+        with self.lock:
+            self.data.get(ns, {}).pop(key, None)
+
+    def scan(self, ns, after=0, limit=None):
+        with self.lock:
+            out = []
+            for key, (seq, value) in self.data.get(ns, {}).items():
+                if seq > after:
+                    out.append((seq, key, value))
+                    if limit is not None and len(out) >= limit:
+                        break
+            return out
+
+    def last_seq(self):
+        return self.seq
+
+    def incr(self, name, by=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + by
+            return self.counters[name]
+
+    def counter(self, name):
+        return self.counters.get(name, 0)
+
+
+class SQLiteStore(Store):
+    """One connection per thread on a WAL database, so readers in every process run alongside a writer."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.local = threading.local()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        db = self._db()
+        db.execute("""
+        CREATE TABLE IF NOT EXISTS kv(
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            ns TEXT NOT NULL,
+            key TEXT NOT NULL,
+            value TEXT NOT NULL,
+            UNIQUE(ns, key)
+        );
+        """)
+        db.execute("CREATE INDEX IF NOT EXISTS kv_ns_seq ON kv(ns, seq)")
+        db.execute("CREATE TABLE IF NOT EXISTS counters(name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+
+    def _db(self) -> sqlite3.Connection:
+        db = getattr(self.local, "db", None)
+        if db is None:
+            # autocommit; every statement below is its own transaction
+            db = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self.local.db = db
+        return db
+
+    def get(self, ns, key):
+        row = self._db().execute("SELECT value FROM kv WHERE ns=? AND key=?", (ns, key)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, ns, key, value):
+        self._db().execute("INSERT INTO kv(ns, key, value) VALUES(?,?,?) "
+                           "ON CONFLICT(ns, key) DO UPDATE SET value=excluded.value", (ns, key, json.dumps(value)))
+
+    def insert(self, ns, key, value):
+        cur = self._db().execute("INSERT OR IGNORE INTO kv(ns, key, value) VALUES(?,?,?)", (ns, key, json.dumps(value)))
+        return cur.rowcount == 1
+
+    def delete(self, ns, key):
+        self._db().execute("DELETE FROM kv WHERE ns=? AND key=?", (ns, key))
+
+    def scan(self, ns, after=0, limit=None):
+        rows = self._db().execute("SELECT seq, key, value FROM kv WHERE ns=? AND seq>? ORDER BY seq LIMIT ?",
+                                  (ns, after, -1 if limit is None else limit)).fetchall()
+        return [(seq, key, json.loads(value)) for seq, key, value in rows]
+
+    def last_seq(self):
+        row = self._db().execute("SELECT seq FROM sqlite_sequence WHERE name='kv'").fetchone()
+        return row[0] if row else 0
+
+    def incr(self, name, by=1):
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.execute("INSERT INTO counters(name, value) VALUES(?, ?) "
+                       "ON CONFLICT(name) DO UPDATE SET value=value+excluded.value", (name, by))
+            value = db.execute("SELECT value FROM counters WHERE name=?", (name,)).fetchone()[0]
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        return value
+
+    def counter(self, name):
+        row = self._db().execute("SELECT value FROM counters WHERE name=?", (name,)).fetchone()
+        return row[0] if row else 0
+
+
+def open_store(url: Optional[str] = None) -> Store:
+    if url is None:
+        url = os.getenv("STORE_URL", "memory://")
+    if url.startswith("memory://"):
+        return MemoryStore()
+    if url.startswith("sqlite://"):
+        return SQLiteStore(url[len("sqlite://"):])
+    raise ValueError(f"unsupported STORE_URL {url!r}")
@@ -0,0 +1,98 @@
+"""Self-contained HMAC-signed bearer tokens shared by the HTTP services.
+
+A token is ``<kid>.<claims>.<sig>``: ``claims`` is base64url JSON with
+``sub`` (username), ``exp`` (unix seconds) and ``jti`` (token id), and ``sig``
+is the base64url HMAC-SHA256 of ``<kid>.<claims>`` under key ``kid``.
+
+Keys come from ``TOKEN_KEYS`` ("kid:secret,kid2:secret2"). Auth signs with
+``TOKEN_ACTIVE_KID``; every key listed stays valid for verification, so a key
+is rotated by adding the new one everywhere, switching the active kid, and
+dropping the old one after ``TOKEN_TTL_S``.
+"""
+import base64, hashlib, hmac, json, os, time, uuid
+from typing import Dict, Iterable, Optional
+
+
+class TokenError(Exception):
+    pass
+
+
+def _b64e(b: bytes) -> str:
+    return base64.urlsafe_b64encode(b).rstrip(b"=").decode("ascii")
+
+
+def _b64d(s: str) -> bytes:
+    return base64.urlsafe_b64decode(s + "=" * (-len(s) % 4))
+
+
+def load_keys(spec: Optional[str] = None) -> Dict[str, bytes]:
+    if spec is None:
+        spec = os.getenv("TOKEN_KEYS", "dev:dev-secret-change-me")
+    keys = {}
+    for part in spec.split(","):
+        kid, _, secret = part.strip().partition(":")
+        if kid and secret:
+            keys[kid] = secret.encode("utf-8")
+    if not keys:
+        raise ValueError("TOKEN_KEYS has no usable kid:secret entries")
+    return keys
+
+
+def token_subject(token: str) -> Optional[str]:
+    """``sub`` of a token without checking it; for services behind the gateway, which already verified it."""
+    try:
+        return json.loads(_b64d(token.split(".")[1])).get("sub")
+    except (IndexError, ValueError):
+        return None
+
+
+class TokenSigner:
+    def __init__(self, keys: Optional[Dict[str, bytes]] = None, active_kid: Optional[str] = None,
+                 ttl_s: Optional[int] = None):
+        self.keys = keys or load_keys()
+        self.active_kid = active_kid or os.getenv("TOKEN_ACTIVE_KID") or next(iter(self.keys))
+        if self.active_kid not in self.keys:
+            raise ValueError(f"active kid {self.active_kid!r} not in TOKEN_KEYS")
+        self.ttl_s = ttl_s or int(os.getenv("TOKEN_TTL_S", "3600"))
+        self.revoked = {}  # jti -> exp; an entry is useless once its token has expired anyway
+
+    def _sign(self, kid: str, signing_input: str) -> str:
+        return _b64e(hmac.new(self.keys[kid], signing_input.encode("ascii"), hashlib.sha256).digest())
+
+    def issue(self, sub: str) -> str:
+        claims = {"sub": sub, "exp": int(time.time()) + self.ttl_s, "jti": uuid.uuid4().hex}
+        signing_input = f"{self.active_kid}.{_b64e(json.dumps(claims, separators=(',', ':')).encode())}"
+        return f"{signing_input}.{self._sign(self.active_kid, signing_input)}"
+
+    def verify(self, token: str) -> dict:
+        """Return the claims of a valid token or raise TokenError. No I/O."""
+        try:
+            kid, body, sig = token.split(".")
+        except ValueError:
+            raise TokenError("malformed token")
+        if kid not in self.keys:
+            raise TokenError("unknown key id")
+        if not hmac.compare_digest(sig, self._sign(kid, f"{kid}.{body}")):
+            raise TokenError("bad signature")
+        try:
+            claims = json.loads(_b64d(body))
+        except ValueError:
+            raise TokenError("malformed claims")
+        if claims.get("exp", 0) < time.time():
+            raise TokenError("token expired")
+        if claims.get("jti") in self.revoked:
+            raise TokenError("token revoked")
+        return claims
+
+    def revoke(self, jti: str, exp: float):
+        self.revoked[jti] = exp
+
+    def merge_revocations(self, entries: Iterable[dict]):
+        for e in entries:
+            self.revoked[e["jti"]] = e["exp"]
+        self.prune()
+
+    def prune(self):
+        now = time.time()
+        for jti in [j for j, exp in self.revoked.items() if exp < now]:
+            del self.revoked[jti]
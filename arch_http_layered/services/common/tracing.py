@@ -0,0 +1,172 @@
+"""Per-hop latency spans for the HTTP services.
+
+A request's trace id comes from ``X-Trace-Id`` (the benchmark sends its
+req_id there) or is minted by the first service that sees it, and is kept in a
+contextvar so outbound calls can forward it with ``trace_headers()``. Jobs
+carry it through the scheduler queue; ``use_trace`` re-enters it in a worker.
+
+Every inbound request gets a ``server`` span, ``span()`` times outbound calls
+(``client``) and compute (``internal``), and the response carries a
+``Server-Timing`` header listing them. Finished spans go to an in-memory
+buffer that a daemon thread appends to ``TRACE_DIR/<service>-<pid>.jsonl``
+every ``TRACE_FLUSH_S``; with ``TRACE_DIR`` unset nothing is written, but
+Server-Timing still works.
+"""
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+import json, os, threading, time, uuid
+
+TRACE_HEADER = "X-Trace-Id"
+TRACE_DIR = os.getenv("TRACE_DIR", "")
+TRACE_FLUSH_S = float(os.getenv("TRACE_FLUSH_S", "1"))
+TRACE_BUFFER_MAX = int(os.getenv("TRACE_BUFFER_MAX", "100000"))  # spans beyond this are dropped, not blocked on
+
+_trace_id = ContextVar("trace_id", default=None)
+_parent_id = ContextVar("parent_span_id", default=None)
+_timings = ContextVar("server_timings", default=None)  # [(name, dur_ms)] for the current inbound request
+
+
+class SpanCollector:
+    def __init__(self, service: str, trace_dir: str):
+        self.service = service
+        self.path = os.path.join(trace_dir, f"{service}-{os.getpid()}.jsonl") if trace_dir else None
+        self.buffer = deque()
+        self.dropped = 0
+        self._started = False
+        self._lock = threading.Lock()
+
+    def record(self, span: dict):
+        if self.path is None:
+            return
+        if len(self.buffer) >= TRACE_BUFFER_MAX:
+            self.dropped += 1
+            return
+        self.buffer.append(span)
+        if not self._started:
+            with self._lock:
+                if not self._started:
+                    os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                    threading.Thread(target=self._run, name="span-flusher", daemon=True).start()
+                    self._started = True
+
+    def _run(self):
+        while True:
+            time.sleep(TRACE_FLUSH_S)
+            lines = []
+            while self.buffer:
+                lines.append(json.dumps(self.buffer.popleft(), separators=(",", ":")))
+            if lines:
+                with open(self.path, "a") as f:
+                    f.write("\n".join(lines) + "\n")
+
+
+_collector = SpanCollector("unknown", "")
+
+
+def configure(service: str):
+    global _collector
+    _collector = SpanCollector(service, TRACE_DIR)
+
+
+def current_trace_id() -> Optional[str]:
+    return _trace_id.get()
+
+
+def trace_headers() -> dict:
+    tid = _trace_id.get()
+    return {TRACE_HEADER: tid} if tid else {}
+
+
+def record_span(name: str, trace_id: Optional[str], start: float, dur_ms: float, kind: str = "internal",
+                parent_id: Optional[str] = None, **attrs) -> str:
+    """Record an already-measured span; `start` is unix seconds. Returns the span id."""
+    span_id = uuid.uuid4().hex[:16]
+    if trace_id:
+        _collector.record({"trace_id": trace_id, "span_id": span_id, "parent_id": parent_id,
+                           "service": _collector.service, "name": name, "kind": kind,
+                           "start": round(start, 6), "dur_ms": round(dur_ms, 3), **attrs})
+    return span_id
+
+
+@contextmanager
+def span(name: str, kind: str = "internal", **attrs):
+    """Time a block as a child of the current span and add it to the response's Server-Timing."""
+    start, t0 = time.time(), time.perf_counter()
+    span_id = uuid.uuid4().hex[:16]
+    token = _parent_id.set(span_id)
+    try:
+        yield
+    finally:
+        _parent_id.reset(token)
+        dur_ms = (time.perf_counter() - t0) * 1000.0
+        timings = _timings.get()
+        if timings is not None:
+            timings.append((name, dur_ms))
+        tid = _trace_id.get()
+        if tid:
+            _collector.record({"trace_id": tid, "span_id": span_id, "parent_id": _parent_id.get(),
+                               "service": _collector.service, "name": name, "kind": kind,
+                               "start": round(start, 6), "dur_ms": round(dur_ms, 3), **attrs})
+
+
+@contextmanager
+def use_trace(trace_id: Optional[str]):
+    """Run a block (e.g. a dequeued job) under a trace id that arrived with it rather than with a request."""
+    token = _trace_id.set(trace_id)
+    try:
+        yield
+    finally:
+        _trace_id.reset(token)
+
+
+def _server_timing(timings, total_ms: float) -> bytes:
+    parts = [f"{name};dur={dur:.1f}" for name, dur in timings]
+    parts.append(f"total;dur={total_ms:.1f}")
+    return ", ".join(parts).encode("latin-1")
+
+
+class TracingMiddleware:
+    """ASGI middleware: server span per request, trace id in and out, Server-Timing on the response."""
+
+    def __init__(self, app, service: str):
+        self.app = app
+        configure(service)
+        self.service = service
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        tid = None
+        for k, v in scope["headers"]:
+            if k == b"x-trace-id":
+                tid = v.decode("latin-1")[:64]
+                break
+        tid = tid or uuid.uuid4().hex
+        span_id = uuid.uuid4().hex[:16]
+        timings = []
+        tokens = (_trace_id.set(tid), _parent_id.set(span_id), _timings.set(timings))
+        start, t0 = time.time(), time.perf_counter()
+        status = [0]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+                headers = list(message.get("headers", []))
+                headers.append((b"x-trace-id", tid.encode("latin-1")))
+                headers.append((b"server-timing", _server_timing(timings, (time.perf_counter() - t0) * 1000.0)))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            endpoint = scope.get("endpoint")
+            name = f"{self.service}.{getattr(endpoint, '__name__', 'unmatched')}"
+            _collector.record({"trace_id": tid, "span_id": span_id, "parent_id": None, "service": self.service,
+                               "name": name, "kind": "server", "start": round(start, 6),
+                               "dur_ms": round((time.perf_counter() - t0) * 1000.0, 3),
+                               "method": scope["method"], "status": status[0]})
+            for var, token in zip((_trace_id, _parent_id, _timings), tokens):
+                var.reset(token)
@@ -1,22 +1,275 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
-import random, time, requests, os
+from contextlib import asynccontextmanager
+from collections import OrderedDict
+from typing import List, Optional, Tuple, Union
+import base64, os, re, sqlite3, tempfile, threading, time, zlib, requests
+import numpy as np
+
+from common.tracing import TracingMiddleware, record_span, span
 
 LEADERBOARD_URL = os.getenv("LEADERBOARD_URL", "http://leaderboard:8005")
+LABELS_DIR = os.getenv("LABELS_DIR", "/data/labels")  # <challenge_id>.npy ground truth, one label per row
+LABEL_CACHE_SIZE = int(os.getenv("LABEL_CACHE_SIZE", "64"))  # challenges kept mapped
+DEFAULT_LABELS_N = int(os.getenv("DEFAULT_LABELS_N", "100"))  # size of demo labels made for unknown challenges
+SCORE_METRIC = os.getenv("SCORE_METRIC", "auc")  # accuracy | auc | rmse (reported negated so higher is better)
+OUTBOX_PATH = os.getenv("OUTBOX_PATH", "/data/outbox/scores.db")
+FLUSH_INTERVAL_MS = float(os.getenv("FLUSH_INTERVAL_MS", "50"))
+FLUSH_MAX_ITEMS = int(os.getenv("FLUSH_MAX_ITEMS", "500"))
 
-app = FastAPI(title="Evaluator (HTTP)")
+_LABELS = OrderedDict()  # challenge_id -> read-only memmap, most recently used last
+_labels_lock = threading.Lock()
+_SAFE_ID = re.compile(r"^[A-Za-z0-9_.-]+$")
 
 class EvalReq(BaseModel):
     submission_id: str
     challenge_id: str
-    pred: float
+    pred: Union[float, List[float], None] = None  # a scalar is broadcast to every label
+    pred_b64: Optional[str] = None  # little-endian float32 array, base64; preferred over pred for large arrays
+    trace_id: Optional[str] = None  # batch items only; a single request's trace comes in X-Trace-Id
+
+class BatchEvalReq(BaseModel):
+    items: List[EvalReq]
+
+
+def _labels_path(challenge_id: str) -> str:
+    if not _SAFE_ID.match(challenge_id):
+        raise HTTPException(400, "invalid challenge_id")
+    return os.path.join(LABELS_DIR, f"{challenge_id}.npy")
+
+
+def _make_demo_labels(path: str, n: int):
+    # Challenges without a ground-truth file get deterministic binary labels so the demo stack scores something.
+    rng = np.random.default_rng(zlib.crc32(os.path.basename(path).encode()))
+    os.makedirs(LABELS_DIR, exist_ok=True)
+    # unique temp name: request threads, and evaluator replicas sharing the directory, may race to create it
+    fd, tmp = tempfile.mkstemp(dir=LABELS_DIR, prefix=os.path.basename(path) + ".", suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        np.save(f, (rng.random(n) >= 0.5).astype(np.uint8))
+    os.replace(tmp, path)
+
+
+def get_labels(challenge_id: str, n_hint: int) -> np.ndarray:
+    """Ground truth for a challenge, memory-mapped once and cached across requests."""
+    with _labels_lock:
+        y = _LABELS.get(challenge_id)
+        if y is not None:
+            _LABELS.move_to_end(challenge_id)
+            return y
+    path = _labels_path(challenge_id)
+    if not os.path.exists(path):
+        _make_demo_labels(path, n_hint or DEFAULT_LABELS_N)
+    y = np.load(path, mmap_mode="r")
+    with _labels_lock:
+        _LABELS[challenge_id] = y
+        while len(_LABELS) > LABEL_CACHE_SIZE:
+            _LABELS.popitem(last=False)
+    return y
+
+
+def decode_pred(e: EvalReq) -> Optional[np.ndarray]:
+    """Prediction vector of a request, or None for a scalar that still has to be broadcast."""
+    if e.pred_b64 is not None:
+        try:
+            return np.frombuffer(base64.b64decode(e.pred_b64), dtype="<f4")
+        except ValueError:
+            raise HTTPException(400, "pred_b64 is not base64 float32")
+    if isinstance(e.pred, list):
+        return np.asarray(e.pred, dtype=np.float32)
+    if e.pred is None:
+        raise HTTPException(400, "pred or pred_b64 required")
+    return None
+
+
+def midranks(P: np.ndarray) -> np.ndarray:
+    """1-based ranks within each row of P; tied values share the average of the ranks they span."""
+    n = P.shape[1]
+    order = P.argsort(axis=1, kind="stable")
+    s = np.take_along_axis(P, order, axis=1)
+    idx = np.broadcast_to(np.arange(n), P.shape)
+    starts = np.ones(P.shape, dtype=bool)  # first position of each run of equal sorted values
+    starts[:, 1:] = s[:, 1:] != s[:, :-1]
+    ends = np.ones(P.shape, dtype=bool)  # last position of each run
+    ends[:, :-1] = starts[:, 1:]
+    first = np.maximum.accumulate(np.where(starts, idx, 0), axis=1)
+    last = np.minimum.accumulate(np.where(ends, idx, n - 1)[:, ::-1], axis=1)[:, ::-1]
+    ranks = np.empty(P.shape, dtype=np.float64)
+    np.put_along_axis(ranks, order, (first + last) / 2.0 + 1.0, axis=1)
+    return ranks
+
+
+def compute_metrics(P: np.ndarray, y: np.ndarray) -> dict:
+    """Row-wise metrics for a (batch, n) prediction matrix against n labels; each value is a length-batch array."""
+    y = np.asarray(y, dtype=np.float32)
+    pos = y >= 0.5
+    accuracy = ((P >= 0.5) == pos).mean(axis=1)
+    rmse = np.sqrt(np.square(P - y).mean(axis=1))
+    n_pos = int(pos.sum())
+    n_neg = y.size - n_pos
+    if n_pos and n_neg:
+        # Mann-Whitney U from prediction ranks; one sort, ranks scattered back
+        auc = (midranks(P)[:, pos].sum(axis=1) - n_pos * (n_pos + 1) / 2.0) / (n_pos * n_neg)
+    else:
+        auc = np.full(P.shape[0], 0.5)
+    return {"accuracy": accuracy, "rmse": rmse, "auc": auc}
+
+
+def _score(metrics: dict) -> np.ndarray:
+    return -metrics["rmse"] if SCORE_METRIC == "rmse" else metrics[SCORE_METRIC]
+
+
+def _score_group(challenge_id: str, preds: List[Optional[np.ndarray]], scalars: List[Optional[float]]) -> List[dict]:
+    n_hint = next((len(p) for p in preds if p is not None), 0)
+    y = get_labels(challenge_id, n_hint)
+    rows = []
+    for p, s in zip(preds, scalars):
+        if p is None:
+            p = np.full(y.shape[0], s, dtype=np.float32)
+        if p.shape[0] != y.shape[0]:
+            raise HTTPException(400, f"expected {y.shape[0]} predictions for {challenge_id}, got {p.shape[0]}")
+        rows.append(p)
+    metrics = compute_metrics(np.vstack(rows), y)
+    scores = _score(metrics)
+    return [{"score": float(scores[i]), "metrics": {k: float(v[i]) for k, v in metrics.items()}}
+            for i in range(len(rows))]
+
+
+class ScoreOutbox:
+    """Leaderboard updates buffered in a local SQLite outbox and sent in batches by a background thread.
+
+    Rows are keyed by (challenge_id, submission_id), so a re-score that is still pending replaces the
+    older score instead of queueing behind it. A row is deleted only after /update_many accepted it;
+    anything left over after a crash is sent on the next start.
+    """
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""
+        CREATE TABLE IF NOT EXISTS outbox(
+            challenge_id TEXT,
+            submission_id TEXT,
+            score REAL,
+            seq INTEGER,
+            PRIMARY KEY(challenge_id, submission_id)
+        );
+        """)
+        self.db.commit()
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.seq = self.db.execute("SELECT COALESCE(MAX(seq), 0) FROM outbox").fetchone()[0]
+        self.unflushed = self.db.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+        self.stats = {"flushed": 0, "batches": 0, "failures": 0}
+
+    def put_many(self, rows: List[Tuple[str, str, float]]):
+        with self.lock, self.db:
+            start = self.seq
+            self.seq += len(rows)
+            self.db.executemany("INSERT OR REPLACE INTO outbox(challenge_id, submission_id, score, seq) VALUES(?,?,?,?)",
+                                [(cid, sid, score, start + i + 1) for i, (cid, sid, score) in enumerate(rows)])
+            self.unflushed += len(rows)
+        if self.unflushed >= FLUSH_MAX_ITEMS:
+            self.wake.set()
+
+    def pending(self) -> int:
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+    def run(self):
+        session = requests.Session()
+        backoff = 0.0
+        while True:
+            self.wake.wait(backoff or FLUSH_INTERVAL_MS / 1000.0)
+            self.wake.clear()
+            with self.lock:
+                rows = self.db.execute("SELECT challenge_id, submission_id, score, seq FROM outbox ORDER BY seq LIMIT ?",
+                                       (FLUSH_MAX_ITEMS,)).fetchall()
+                self.unflushed = 0
+            if not rows:
+                continue
+            try:
+                r = session.post(f"{LEADERBOARD_URL}/update_many", timeout=10, json={
+                    "updates": [{"challenge_id": c, "submission_id": s, "score": sc} for c, s, sc, _ in rows]})
+                r.raise_for_status()
+            except Exception:
+                self.stats["failures"] += 1
+                backoff = min(5.0, max(0.1, backoff * 2))
+                continue
+            backoff = 0.0
+            with self.lock, self.db:
+                # a row re-scored since we read it has a new seq and stays for the next batch
+                self.db.executemany("DELETE FROM outbox WHERE challenge_id=? AND submission_id=? AND seq=?",
+                                    [(c, s, q) for c, s, _, q in rows])
+            self.stats["flushed"] += len(rows)
+            self.stats["batches"] += 1
+            if len(rows) == FLUSH_MAX_ITEMS:
+                self.wake.set()
+
+
+OUTBOX = None
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global OUTBOX
+    OUTBOX = ScoreOutbox(OUTBOX_PATH)
+    threading.Thread(target=OUTBOX.run, name="outbox-flusher", daemon=True).start()
+    yield
+
+
+app = FastAPI(title="Evaluator (HTTP)", lifespan=lifespan)
+app.add_middleware(TracingMiddleware, service="evaluator")
+
+
+def _update_leaderboard(challenge_id: str, submission_id: str, score: float):
+    OUTBOX.put_many([(challenge_id, submission_id, score)])
 
 
 @app.post("/evaluate")
 def evaluate(e: EvalReq):
-    # Simulate metric computation
-    time.sleep(0.02)
-    score = e.pred+0.5
-    # Update leaderboard
-    requests.post(f"{LEADERBOARD_URL}/update", json={"challenge_id": e.challenge_id, "submission_id": e.submission_id, "score": score})
-    return {"score": score}
+    with span("score"):
+        result = _score_group(e.challenge_id, [decode_pred(e)], [e.pred if not isinstance(e.pred, list) else None])[0]
+    # Queue the leaderboard update; the outbox flusher sends it
+    with span("outbox"):
+        _update_leaderboard(e.challenge_id, e.submission_id, result["score"])
+    return result
+
+
+@app.post("/evaluate_bin")
+async def evaluate_bin(request: Request, submission_id: str, challenge_id: str):
+    """Raw little-endian float32 predictions as the request body (application/octet-stream)."""
+    body = await request.body()
+    if len(body) % 4:
+        raise HTTPException(400, "body is not a float32 array")
+    p = np.frombuffer(body, dtype="<f4")
+    result = (await run_in_threadpool(_score_group, challenge_id, [p], [None]))[0]
+    await run_in_threadpool(_update_leaderboard, challenge_id, submission_id, result["score"])
+    return result
+
+
+@app.post("/evaluate_batch")
+def evaluate_batch(b: BatchEvalReq):
+    # Score each challenge's rows as one matrix
+    results = [None] * len(b.items)
+    groups = OrderedDict()  # challenge_id -> indices into b.items
+    for i, it in enumerate(b.items):
+        groups.setdefault(it.challenge_id, []).append(i)
+    for cid, idx in groups.items():
+        items = [b.items[i] for i in idx]
+        start, t0 = time.time(), time.perf_counter()
+        scored = _score_group(cid, [decode_pred(it) for it in items],
+                              [it.pred if not isinstance(it.pred, list) else None for it in items])
+        dur_ms = (time.perf_counter() - t0) * 1000.0
+        for i, r in zip(idx, scored):
+            results[i] = r
+            record_span("score", b.items[i].trace_id, start, dur_ms, batch_size=len(idx))
+    OUTBOX.put_many([(it.challenge_id, it.submission_id, r["score"]) for it, r in zip(b.items, results)])
+    return {"scores": [r["score"] for r in results], "results": results}
+
+
+@app.get("/outbox")
+def outbox_stats():
+    return {"pending": OUTBOX.pending(), **OUTBOX.stats}
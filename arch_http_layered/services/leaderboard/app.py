@@ -1,23 +1,197 @@
-from fastapi import FastAPI
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import Response, StreamingResponse
 from pydantic import BaseModel
-from heapq import nlargest
+from itertools import takewhile
+from typing import List, Optional
+from sortedcontainers import SortedList
+import asyncio, json, os
 
-app = FastAPI(title="Leaderboard (HTTP)")
+from common.scorelog import ScoreLog
+from common.tracing import TracingMiddleware
+
+# k values whose top-k JSON is kept pre-encoded; other k are served straight from the index
+TOP_CACHE_K = sorted({int(k) for k in os.getenv("TOP_CACHE_K", "10,20,50,100").split(",") if k.strip()})
+FEED_TOP_K = int(os.getenv("FEED_TOP_K", "100"))  # /feed publishes a challenge when its top FEED_TOP_K changes
+FEED_PING_S = float(os.getenv("FEED_PING_S", "15"))
+SCORE_DIR = os.getenv("SCORE_DIR", "")  # empty: scores live in memory only
+
+
+class Board:
+    """One challenge's scores kept in rank order (best first, ties by submission id)."""
+
+    def __init__(self):
+        self.scores = {}  # submission_id -> score
+        self.order = SortedList()  # (-score, submission_id)
+        self.top_cache = {}  # k -> encoded top-k JSON
+
+    @classmethod
+    def from_scores(cls, scores: dict) -> "Board":
+        """Bulk-load a recovered board with one sort instead of n inserts."""
+        board = cls()
+        board.scores = scores
+        board.order = SortedList((-score, sid) for sid, score in scores.items())
+        return board
+
+    def upsert(self, submission_id: str, score: float) -> Optional[int]:
+        """Insert or move an entry in O(log n); returns the first rank position that changed, None if nothing did."""
+        old = self.scores.get(submission_id)
+        if old == score:
+            return None
+        first = len(self.order)
+        if old is not None:
+            first = self.order.bisect_left((-old, submission_id))
+            self.order.remove((-old, submission_id))
+        self.scores[submission_id] = score
+        self.order.add((-score, submission_id))
+        first = min(first, self.order.bisect_left((-score, submission_id)))
+        # Entries from `first` down shifted or changed; cached top-k above it are still exact
+        for k in [k for k in self.top_cache if k > first]:
+            del self.top_cache[k]
+        return first
+
+    def top_json(self, k: int) -> bytes:
+        body = self.top_cache.get(k)
+        if body is None:
+            body = json.dumps(_entries(self.order.islice(0, k))).encode()
+            if k in TOP_CACHE_K:
+                self.top_cache[k] = body
+        return body
+
+    def rank(self, submission_id: str) -> Optional[int]:
+        score = self.scores.get(submission_id)
+        if score is None:
+            return None
+        return self.order.bisect_left((-score, submission_id)) + 1
+
+
+LB = {}  # challenge_id -> Board
+FEEDS = set()  # one _FeedSubscriber per open /feed stream
+SCORES = None  # ScoreLog when SCORE_DIR is set
+
+
+def _snapshot_state():
+    # runs on the score-log thread; dict copies are atomic under the GIL
+    return [(cid, board.scores.copy()) for cid, board in list(LB.items())]
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global SCORES
+    if SCORE_DIR:
+        SCORES = ScoreLog(SCORE_DIR, _snapshot_state)
+        for cid, scores in SCORES.recover().items():
+            LB[cid] = Board.from_scores(scores)
+        SCORES.start()
+    yield
+    if SCORES is not None:
+        SCORES.close()
+
+
+app = FastAPI(title="Leaderboard (HTTP)", lifespan=lifespan)
+app.add_middleware(TracingMiddleware, service="leaderboard")
+
+
+class _FeedSubscriber:
+    def __init__(self):
+        self.dirty = set()  # challenges whose top changed since the last event we sent
+        self.event = asyncio.Event()
+
+
+def _apply(u: "Update"):
+    first = LB.setdefault(u.challenge_id, Board()).upsert(u.submission_id, u.score)
+    if first is not None and SCORES is not None:
+        SCORES.append(u.challenge_id, u.submission_id, u.score)
+    if first is not None and first < FEED_TOP_K:
+        for f in FEEDS:
+            f.dirty.add(u.challenge_id)
+            f.event.set()
+
+
+def _entries(keys):
+    return [{"submission_id": s, "score": -neg} for neg, s in keys]
 
-LB = {}  # challenge_id -> {submission_id: score}
 
 class Update(BaseModel):
     challenge_id: str
     submission_id: str
     score: float
 
+class UpdateMany(BaseModel):
+    updates: List[Update]
+
 @app.post("/update")
-def update(u: Update):
-    LB.setdefault(u.challenge_id, {})[u.submission_id] = u.score
+async def update(u: Update):
+    _apply(u)
     return {"status": "ok"}
 
+@app.post("/update_many")
+async def update_many(b: UpdateMany):
+    # Applied in order, so a later update for the same submission wins
+    for u in b.updates:
+        _apply(u)
+    return {"status": "ok", "applied": len(b.updates)}
+
 @app.get("/top/{challenge_id}")
-def top(challenge_id: str, k: int = 10):
-    items = LB.get(challenge_id, {}).items()
-    topk = nlargest(k, items, key=lambda kv: kv[1])
-    return [{"submission_id": s, "score": sc} for s, sc in topk]
+async def top(challenge_id: str, k: int = 10):
+    board = LB.get(challenge_id)
+    if board is None:
+        return []
+    return Response(board.top_json(max(0, k)), media_type="application/json")
+
+@app.get("/rank/{challenge_id}/{submission_id}")
+async def rank(challenge_id: str, submission_id: str):
+    board = LB.get(challenge_id)
+    r = board.rank(submission_id) if board else None
+    if r is None:
+        raise HTTPException(404, "not found")
+    return {"submission_id": submission_id, "score": board.scores[submission_id], "rank": r, "total": len(board.order)}
+
+@app.get("/page/{challenge_id}")
+async def page(challenge_id: str, offset: int = 0, limit: int = 50):
+    board = LB.get(challenge_id) or Board()
+    offset, limit = max(0, offset), max(0, min(limit, 1000))
+    return {"total": len(board.order), "offset": offset,
+            "items": _entries(board.order.islice(offset, offset + limit))}
+
+@app.get("/range/{challenge_id}")
+async def score_range(challenge_id: str, min_score: Optional[float] = None, max_score: Optional[float] = None, limit: int = 100):
+    """Entries with min_score <= score <= max_score, best first."""
+    board = LB.get(challenge_id) or Board()
+    start = 0 if max_score is None else board.order.bisect_left((-max_score,))
+    keys = board.order.islice(start, start + max(0, min(limit, 1000)))
+    if min_score is not None:
+        keys = takewhile(lambda key: -key[0] >= min_score, keys)
+    return {"items": _entries(keys)}
+
+@app.get("/persistence")
+async def persistence():
+    return SCORES.stats if SCORES is not None else {"enabled": False}
+
+@app.get("/feed")
+async def feed():
+    """Server-Sent Events: one `top` event with the current top FEED_TOP_K whenever a challenge's top changes.
+
+    Changes are coalesced per subscriber: a slow reader gets the latest top once, not every step in between.
+    """
+    sub = _FeedSubscriber()
+    FEEDS.add(sub)
+
+    async def events():
+        try:
+            yield ": connected\n\n"
+            while True:
+                try:
+                    await asyncio.wait_for(sub.event.wait(), FEED_PING_S)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+                    continue
+                sub.event.clear()
+                dirty, sub.dirty = sub.dirty, set()
+                for cid in dirty:
+                    top = LB[cid].top_json(FEED_TOP_K).decode()
+                    yield f'event: top\ndata: {{"challenge_id": {json.dumps(cid)}, "top": {top}}}\n\n'
+        finally:
+            FEEDS.discard(sub)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
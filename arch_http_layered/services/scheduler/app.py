@@ -1,34 +1,486 @@
 from fastapi import FastAPI, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
-import uuid, time, requests, os
+from contextlib import asynccontextmanager
+from collections import deque
+from enum import IntEnum
+from typing import List, Optional
+from common.tokens import token_subject
+from common.tracing import TracingMiddleware, current_trace_id, record_span, span, trace_headers, use_trace
+import asyncio, itertools, logging, uuid, time, os, sqlite3, sys, threading, httpx
 
-WORKER_URL = os.getenv("WORKER_URL", "http://worker:8003")
+log = logging.getLogger("scheduler")
 
-app = FastAPI(title="Scheduler (HTTP)")
+MAX_QUEUE_DEPTH = int(os.getenv("MAX_QUEUE_DEPTH", "1000"))
+MAX_LEASE_BATCH = int(os.getenv("MAX_LEASE_BATCH", "32"))
+LEASE_TIMEOUT_S = float(os.getenv("LEASE_TIMEOUT_S", "30"))
+MAX_ATTEMPTS = int(os.getenv("MAX_ATTEMPTS", "3"))
+RETRY_AFTER_S = int(os.getenv("RETRY_AFTER_S", "1"))
+# pull: workers lease jobs themselves. push: the scheduler sends each job to the registered
+# worker with the fewest in-flight jobs (run workers with PULL_ENABLED=0).
+DISPATCH_MODE = os.getenv("DISPATCH_MODE", "pull")
+HEALTH_INTERVAL_S = float(os.getenv("HEALTH_INTERVAL_S", "2"))
+HEALTH_TIMEOUT_S = float(os.getenv("HEALTH_TIMEOUT_S", "0.5"))  # a probe slower than this takes the worker out of rotation
+HEARTBEAT_TTL_S = float(os.getenv("HEARTBEAT_TTL_S", "10"))
+MAX_CONSECUTIVE_FAILURES = int(os.getenv("MAX_CONSECUTIVE_FAILURES", "3"))
+ARCHIVE_PATH = os.getenv("ARCHIVE_PATH", "/data/scheduler/archive.db")
+ARCHIVE_AFTER_S = float(os.getenv("ARCHIVE_AFTER_S", "300"))  # finished jobs stay in memory this long, then move to disk
+ARCHIVE_INTERVAL_S = float(os.getenv("ARCHIVE_INTERVAL_S", "5"))
+ARCHIVE_BATCH = int(os.getenv("ARCHIVE_BATCH", "5000"))
+MAX_STATUS_WAIT_S = float(os.getenv("MAX_STATUS_WAIT_S", "60"))
+MAX_STATUS_BATCH = int(os.getenv("MAX_STATUS_BATCH", "1000"))
 
-SUBMISSIONS = {}  # id -> {"user":..., "challenge_id":..., "state":..., "payload":...}
+
+class State(IntEnum):
+    QUEUED = 0
+    RUNNING = 1
+    SCORED = 2
+    FAILED = 3
+
+
+class Job:
+    """A submission the scheduler still holds in memory. The payload is dropped once the job is finished."""
+
+    __slots__ = ("user", "challenge_id", "state", "payload", "attempts", "score", "error", "finished_at",
+                 "trace_id", "queued_at")
+
+    def __init__(self, user: str, challenge_id: str, payload: dict, trace_id: Optional[str] = None):
+        # usernames and challenge ids repeat across many jobs; keep one copy of each string
+        self.user = sys.intern(user)
+        self.challenge_id = sys.intern(challenge_id)
+        self.state = State.QUEUED
+        self.payload = payload
+        self.attempts = 0
+        self.score = None
+        self.error = None
+        self.finished_at = None
+        self.trace_id = trace_id  # from the /submit request, so worker and evaluator spans join its trace
+        self.queued_at = time.time()
+
+    def to_dict(self) -> dict:
+        d = {"user": self.user, "challenge_id": self.challenge_id, "state": self.state.name, "attempts": self.attempts}
+        if self.payload is not None:
+            d["payload"] = self.payload
+        if self.score is not None:
+            d["score"] = self.score
+        if self.error:
+            d["error"] = self.error
+        return d
+
+
+class Archive:
+    """Append-only SQLite table of finished submissions, so memory only holds jobs that can still change."""
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""
+        CREATE TABLE IF NOT EXISTS submissions(
+            submission_id TEXT PRIMARY KEY,
+            user TEXT,
+            challenge_id TEXT,
+            state TEXT,
+            attempts INTEGER,
+            score REAL,
+            error TEXT,
+            finished_at REAL
+        );
+        """)
+        self.db.commit()
+        self.lock = threading.Lock()
+        self.archived = 0  # rows written by this process
+
+    def append(self, rows: List[tuple]):
+        with self.lock, self.db:
+            self.db.executemany("INSERT OR IGNORE INTO submissions VALUES(?,?,?,?,?,?,?,?)", rows)
+        self.archived += len(rows)
+
+    def get(self, sid: str) -> Optional[dict]:
+        with self.lock:
+            row = self.db.execute("SELECT user, challenge_id, state, attempts, score, error FROM submissions WHERE submission_id=?",
+                                  (sid,)).fetchone()
+        if row is None:
+            return None
+        return self._record(row)
+
+    def get_many(self, sids: List[str]) -> dict:
+        out = {}
+        with self.lock:
+            for i in range(0, len(sids), 500):  # stay under SQLite's bound-parameter limit
+                chunk = sids[i:i + 500]
+                out.update((row[0], self._record(row[1:])) for row in self.db.execute(
+                    "SELECT submission_id, user, challenge_id, state, attempts, score, error FROM submissions "
+                    f"WHERE submission_id IN ({','.join('?' * len(chunk))})", chunk))
+        return out
+
+    @staticmethod
+    def _record(row) -> dict:
+        d = {"user": row[0], "challenge_id": row[1], "state": row[2], "attempts": row[3]}
+        if row[4] is not None:
+            d["score"] = row[4]
+        if row[5]:
+            d["error"] = row[5]
+        return d
+
+
+SUBMISSIONS = {}  # id -> Job, until archived
+QUEUE = deque()  # submission ids waiting for a worker, oldest first
+FINISHED = deque()  # (finished_at, id) of terminal jobs still in memory, oldest first
+LEASES = {}  # submission id -> {"worker_id":..., "deadline":..., "started":...} while RUNNING
+WORKERS = {}  # worker id -> registry entry, see _worker()
+WATCHERS = {}  # submission id -> asyncio.Event a /status long-poll waits on; removed and set on the next state change
+ARCHIVE = None
+
+_work_available = None  # asyncio.Event, set while QUEUE is non-empty
+_capacity_freed = None  # asyncio.Event, set when a worker may have a free slot (push mode)
+
+
+def _worker(worker_id: str, url: Optional[str] = None, capacity: int = 1) -> dict:
+    w = WORKERS.get(worker_id)
+    if w is None:
+        w = WORKERS[worker_id] = {"worker_id": worker_id, "url": url, "capacity": capacity, "healthy": True,
+                                  "inflight": 0, "reported_inflight": 0, "completed": 0, "failed": 0,
+                                  "consecutive_failures": 0, "ewma_latency_ms": 0.0, "last_seen": time.monotonic()}
+    w["last_seen"] = time.monotonic()
+    return w
+
+
+def _set_state(job: Job, sid: str, state: State):
+    job.state = state
+    ev = WATCHERS.pop(sid, None)
+    if ev is not None:
+        ev.set()
+
+
+def _start_lease(sid: str, worker_id: str, deadline: float):
+    job = SUBMISSIONS[sid]
+    record_span("queue_wait", job.trace_id, job.queued_at, (time.time() - job.queued_at) * 1000.0, attempt=job.attempts + 1)
+    _set_state(job, sid, State.RUNNING)
+    job.attempts += 1
+    LEASES[sid] = {"worker_id": worker_id, "deadline": deadline, "started": time.monotonic()}
+    _worker(worker_id)["inflight"] += 1
+
+
+def _end_lease(sid: str) -> dict:
+    l = LEASES.pop(sid)
+    w = WORKERS.get(l["worker_id"])
+    if w is not None:
+        w["inflight"] -= 1
+        _capacity_freed.set()
+    return l
+
+
+def _terminate(sid: str, state: State):
+    job = SUBMISSIONS[sid]
+    job.payload = None
+    job.finished_at = time.time()
+    FINISHED.append((time.monotonic(), sid))
+    _set_state(job, sid, state)
+
+
+def _requeue(sid: str, error: str):
+    job = SUBMISSIONS[sid]
+    if job.attempts >= MAX_ATTEMPTS:
+        job.error = error
+        _terminate(sid, State.FAILED)
+    else:
+        job.queued_at = time.time()
+        _set_state(job, sid, State.QUEUED)
+        QUEUE.appendleft(sid)
+        _work_available.set()
+
+
+def _finish(sid: str, state: State, score: Optional[float], error: Optional[str]):
+    l = _end_lease(sid)
+    w = WORKERS.get(l["worker_id"])
+    if w is not None:
+        ms = (time.monotonic() - l["started"]) * 1000.0
+        w["ewma_latency_ms"] = ms if not w["completed"] else 0.8 * w["ewma_latency_ms"] + 0.2 * ms
+        w["completed"] += 1
+        if state == State.FAILED:
+            w["failed"] += 1
+    job = SUBMISSIONS[sid]
+    if score is not None:
+        job.score = score
+    if error:
+        job.error = error
+    _terminate(sid, state)
+
+
+async def _reap_expired_leases():
+    # A worker that dies mid-job never calls back; put its jobs back in line.
+    while True:
+        await asyncio.sleep(1.0)
+        now = time.monotonic()
+        for sid in [sid for sid, l in LEASES.items() if l["deadline"] < now]:
+            _end_lease(sid)
+            _requeue(sid, "lease expired")
+
+
+async def _archive_finished():
+    """Move jobs finished more than ARCHIVE_AFTER_S ago from memory to the archive."""
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(ARCHIVE_INTERVAL_S)
+        cutoff = time.monotonic() - ARCHIVE_AFTER_S
+        while FINISHED and FINISHED[0][0] <= cutoff:
+            # only appended to meanwhile, so the batch stays at the front until it is on disk
+            sids = [sid for _, sid in itertools.takewhile(lambda f: f[0] <= cutoff, itertools.islice(FINISHED, ARCHIVE_BATCH))]
+            try:
+                jobs = [(sid, SUBMISSIONS[sid]) for sid in sids if sid in SUBMISSIONS]
+                rows = [(sid, j.user, j.challenge_id, j.state.name, j.attempts, j.score, j.error, j.finished_at)
+                        for sid, j in jobs]
+                # written off the event loop; /status keeps answering from memory until the rows are on disk
+                await loop.run_in_executor(None, ARCHIVE.append, rows)
+            except Exception:
+                log.exception("archiving %d finished jobs failed; retrying in %ss", len(sids), ARCHIVE_INTERVAL_S)
+                break
+            for sid in sids:
+                FINISHED.popleft()
+                SUBMISSIONS.pop(sid, None)
+
+
+async def _health_checks():
+    """Probe registered workers; failing, slow or silent ones leave the rotation until they recover."""
+    async def probe(client, w):
+        if time.monotonic() - w["last_seen"] > HEARTBEAT_TTL_S:
+            return False
+        if not w["url"]:
+            return True  # pull-only worker, heartbeats are all we have
+        try:
+            return (await client.get(f"{w['url']}/healthz")).status_code == 200
+        except httpx.HTTPError:
+            return False
+
+    async with httpx.AsyncClient(timeout=HEALTH_TIMEOUT_S) as client:
+        while True:
+            await asyncio.sleep(HEALTH_INTERVAL_S)
+            now = time.monotonic()
+            for wid in [wid for wid, w in WORKERS.items() if w["inflight"] == 0 and now - w["last_seen"] > 10 * HEARTBEAT_TTL_S]:
+                del WORKERS[wid]  # scaled down or gone for good
+            workers = list(WORKERS.values())
+            for w, ok in zip(workers, await asyncio.gather(*[probe(client, w) for w in workers])):
+                if ok and not w["healthy"]:
+                    w["consecutive_failures"] = 0
+                    _capacity_freed.set()
+                w["healthy"] = ok
+
+
+def _pick_worker() -> Optional[dict]:
+    # least outstanding requests; ties go to the replica that has been faster lately
+    candidates = [w for w in WORKERS.values() if w["healthy"] and w["url"] and w["inflight"] < w["capacity"]]
+    return min(candidates, key=lambda w: (w["inflight"], w["ewma_latency_ms"]), default=None)
+
+
+async def _push(client: httpx.AsyncClient, w: dict, sid: str):
+    job = SUBMISSIONS[sid]
+    try:
+        with use_trace(job.trace_id), span("call.worker", kind="client", worker_id=w["worker_id"]):
+            r = await client.post(f"{w['url']}/run", headers=trace_headers(),
+                                  json={"submission_id": sid, "challenge_id": job.challenge_id, "payload": job.payload})
+        r.raise_for_status()
+        res = r.json()
+    except Exception as e:
+        w["consecutive_failures"] += 1
+        if w["consecutive_failures"] >= MAX_CONSECUTIVE_FAILURES:
+            w["healthy"] = False
+        if LEASES.get(sid, {}).get("worker_id") == w["worker_id"]:
+            _end_lease(sid)
+            _requeue(sid, f"dispatch error: {e}")
+        return
+    w["consecutive_failures"] = 0
+    if LEASES.get(sid, {}).get("worker_id") == w["worker_id"]:
+        _finish(sid, State[res.get("state", "SCORED")], res.get("score"), res.get("error"))
+
+
+async def _push_dispatcher():
+    async with httpx.AsyncClient(timeout=LEASE_TIMEOUT_S) as client:
+        while True:
+            while not QUEUE:
+                _work_available.clear()
+                await _work_available.wait()
+            w = _pick_worker()
+            if w is None:
+                _capacity_freed.clear()
+                try:
+                    await asyncio.wait_for(_capacity_freed.wait(), HEALTH_INTERVAL_S)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            sid = QUEUE.popleft()
+            _start_lease(sid, w["worker_id"], time.monotonic() + LEASE_TIMEOUT_S)
+            asyncio.ensure_future(_push(client, w, sid))
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global _work_available, _capacity_freed, ARCHIVE
+    _work_available = asyncio.Event()
+    _capacity_freed = asyncio.Event()
+    ARCHIVE = Archive(ARCHIVE_PATH)
+    tasks = [asyncio.create_task(_reap_expired_leases()), asyncio.create_task(_health_checks()),
+             asyncio.create_task(_archive_finished())]
+    if DISPATCH_MODE == "push":
+        tasks.append(asyncio.create_task(_push_dispatcher()))
+    yield
+    for t in tasks:
+        t.cancel()
+
+
+app = FastAPI(title="Scheduler (HTTP)", lifespan=lifespan)
+app.add_middleware(TracingMiddleware, service="scheduler")
 
 class Submission(BaseModel):
     token: str
     challenge_id: str
     payload: dict  # points to code artifact ID / params
 
+class LeaseReq(BaseModel):
+    worker_id: str
+    max_jobs: int = 1
+    wait_s: float = 10.0  # long-poll: how long to wait for work if the queue is empty
+
+class CompleteReq(BaseModel):
+    worker_id: str
+    state: str  # SCORED | FAILED
+    score: Optional[float] = None
+    error: Optional[str] = None
+
+class RegisterWorker(BaseModel):
+    worker_id: str
+    url: Optional[str] = None  # where /run and /healthz are served; None for pull-only workers
+    capacity: int = 8
+
+class Heartbeat(BaseModel):
+    inflight: int = 0
+
+class StatusBatch(BaseModel):
+    ids: List[str]
+
 @app.post("/submit")
-def submit(s: Submission):
+async def submit(s: Submission):
+    if len(QUEUE) >= MAX_QUEUE_DEPTH:
+        raise HTTPException(429, "queue full", headers={"Retry-After": str(RETRY_AFTER_S)})
     sid = str(uuid.uuid4())
-    SUBMISSIONS[sid] = {"user": s.token, "challenge_id": s.challenge_id, "state":"QUEUED", "payload": s.payload}
-    # dispatch to worker
+    SUBMISSIONS[sid] = Job(token_subject(s.token) or "", s.challenge_id, s.payload, current_trace_id())
+    QUEUE.append(sid)
+    _work_available.set()
+    return {"submission_id": sid, "state": "QUEUED"}
+
+@app.post("/lease")
+async def lease(req: LeaseReq):
+    _worker(req.worker_id)
+    deadline = time.monotonic() + max(0.0, req.wait_s)
+    while not QUEUE:
+        _work_available.clear()
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return {"jobs": [], "lease_timeout_s": LEASE_TIMEOUT_S}
+        try:
+            await asyncio.wait_for(_work_available.wait(), remaining)
+        except asyncio.TimeoutError:
+            pass
+    jobs = []
+    lease_deadline = time.monotonic() + LEASE_TIMEOUT_S
+    while QUEUE and len(jobs) < min(max(1, req.max_jobs), MAX_LEASE_BATCH):
+        sid = QUEUE.popleft()
+        _start_lease(sid, req.worker_id, lease_deadline)
+        job = SUBMISSIONS[sid]
+        jobs.append({"submission_id": sid, "challenge_id": job.challenge_id, "payload": job.payload, "trace_id": job.trace_id})
+    if not QUEUE:
+        _work_available.clear()
+    return {"jobs": jobs, "lease_timeout_s": LEASE_TIMEOUT_S}
+
+@app.post("/jobs/{sid}/complete")
+async def complete(sid: str, c: CompleteReq):
+    l = LEASES.get(sid)
+    if l is None or l["worker_id"] != c.worker_id:
+        # lease expired and the job was handed to someone else (or already finished)
+        raise HTTPException(409, "no active lease for this worker")
+    if c.state not in ("SCORED", "FAILED"):
+        raise HTTPException(400, "state must be SCORED or FAILED")
+    _finish(sid, State[c.state], c.score, c.error)
+    return {"submission_id": sid, "state": c.state}
+
+@app.post("/workers/register")
+async def register_worker(r: RegisterWorker):
+    w = _worker(r.worker_id, r.url, r.capacity)
+    w["url"], w["capacity"], w["healthy"] = r.url, max(1, r.capacity), True
+    _capacity_freed.set()
+    return {"worker_id": r.worker_id, "heartbeat_ttl_s": HEARTBEAT_TTL_S}
+
+@app.post("/workers/{worker_id}/heartbeat")
+async def heartbeat(worker_id: str, h: Heartbeat):
+    if worker_id not in WORKERS:
+        raise HTTPException(404, "unknown worker, register again")
+    _worker(worker_id)["reported_inflight"] = h.inflight
+    return {"status": "ok"}
+
+@app.get("/workers")
+async def workers():
+    now = time.monotonic()
+    return {"dispatch_mode": DISPATCH_MODE,
+            "workers": [{**{k: v for k, v in w.items() if k != "last_seen"}, "last_seen_s_ago": round(now - w["last_seen"], 3)}
+                        for w in WORKERS.values()]}
+
+@app.get("/queue")
+async def queue_stats():
+    return {"depth": len(QUEUE), "max_depth": MAX_QUEUE_DEPTH, "leased": len(LEASES),
+            "in_memory": len(SUBMISSIONS), "archived": ARCHIVE.archived}
+
+def _parse_wait(wait: str) -> float:
+    # "30s", "500ms", "2m" or plain seconds
+    w = wait.strip().lower()
     try:
-        r = requests.post(f"{WORKER_URL}/run", json={"submission_id": sid, "payload": s.payload, "challenge_id": s.challenge_id})
-        r.raise_for_status()
-        SUBMISSIONS[sid]["state"] = "RUNNING"
-    except Exception as e:
-        SUBMISSIONS[sid]["state"] = "FAILED_DISPATCH"
-        raise HTTPException(500, f"dispatch error: {e}")
-    return {"submission_id": sid, "state": SUBMISSIONS[sid]["state"]}
+        for suffix, scale in (("ms", 0.001), ("s", 1.0), ("m", 60.0)):
+            if w.endswith(suffix):
+                return float(w[:-len(suffix)]) * scale
+        return float(w)
+    except ValueError:
+        raise HTTPException(400, "wait must look like 30s, 500ms or 2m")
+
+
+@app.post("/status/batch")
+async def status_batch(b: StatusBatch):
+    """States of many submissions in one call; unknown ids map to null."""
+    if len(b.ids) > MAX_STATUS_BATCH:
+        raise HTTPException(400, f"at most {MAX_STATUS_BATCH} ids per call")
+    out = {sid: (SUBMISSIONS[sid].to_dict() if sid in SUBMISSIONS else None) for sid in b.ids}
+    missing = [sid for sid, rec in out.items() if rec is None]
+    if missing:
+        out.update(await run_in_threadpool(ARCHIVE.get_many, missing))
+    return {"statuses": out}
 
 @app.get("/status/{sid}")
-def status(sid: str):
-    if sid not in SUBMISSIONS:
+async def status(sid: str, wait: Optional[str] = None, since_state: Optional[str] = None):
+    """With `wait`, hold the request until the state differs from `since_state` (default: the current
+    state) or the wait runs out, then return the status either way."""
+    job = SUBMISSIONS.get(sid)
+    if job is not None and wait is not None:
+        timeout = min(max(0.0, _parse_wait(wait)), MAX_STATUS_WAIT_S)
+        if since_state is None:
+            since = job.state
+        elif since_state.upper() in State.__members__:
+            since = State[since_state.upper()]
+        else:
+            raise HTTPException(400, f"since_state must be one of {', '.join(State.__members__)}")
+        deadline = time.monotonic() + timeout
+        while job.state == since and job.state not in (State.SCORED, State.FAILED):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            ev = WATCHERS.get(sid)
+            if ev is None:
+                ev = WATCHERS[sid] = asyncio.Event()
+            try:
+                await asyncio.wait_for(ev.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+    if job is not None:
+        return job.to_dict()
+    rec = await run_in_threadpool(ARCHIVE.get, sid)
+    if rec is None:
         raise HTTPException(404, "not found")
-    return SUBMISSIONS[sid]
+    return rec
@@ -1,10 +1,369 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
-import time, requests, os, random
+from contextlib import asynccontextmanager
+from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict
+from typing import List, Tuple
+import asyncio, base64, multiprocessing, time, os, random, re, socket, tempfile, zlib, httpx
+import numpy as np
+
+from common.tracing import TracingMiddleware, current_trace_id, record_span, span, trace_headers, use_trace
+
+
+def _usable_cores() -> int:
+    try:
+        return len(os.sched_getaffinity(0))  # honours cpusets / docker --cpuset-cpus
+    except AttributeError:
+        return os.cpu_count() or 1
+
 
 EVALUATOR_URL = os.getenv("EVALUATOR_URL", "http://evaluator:8004")
+SCHEDULER_URL = os.getenv("SCHEDULER_URL", "http://scheduler:8002")
+WORKER_ID = os.getenv("WORKER_ID") or socket.gethostname()
+INFERENCE_PROCS = int(os.getenv("INFERENCE_PROCS") or _usable_cores())  # processes running inference
+# Jobs admitted at once (running + waiting for a process); anything beyond is rejected with 503
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY") or INFERENCE_PROCS)
+LEASE_WAIT_S = float(os.getenv("LEASE_WAIT_S", "10"))
+PULL_ENABLED = os.getenv("PULL_ENABLED", "1") == "1"
+PORT = int(os.getenv("PORT", "8003"))
+# how the scheduler reaches this replica for push dispatch and health checks
+WORKER_ADVERTISE_URL = os.getenv("WORKER_ADVERTISE_URL") or f"http://{socket.gethostbyname(socket.gethostname())}:{PORT}"
+HEARTBEAT_S = float(os.getenv("HEARTBEAT_S", "3"))
+# Micro-batching: run concurrent jobs as one inference call and one bulk evaluator request.
+BATCH_MODE = os.getenv("BATCH_MODE", "0") == "1"
+BATCH_WINDOW_MS = float(os.getenv("BATCH_WINDOW_MS", "10"))
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "32"))
+ARTIFACT_DIR = os.getenv("ARTIFACT_DIR", "/data/artifacts")  # <artifact>.npy model weights, (features, outputs)
+ARTIFACT_CACHE_BYTES = int(os.getenv("ARTIFACT_CACHE_BYTES", str(512 * 1024 * 1024)))  # per inference process
+DEFAULT_ARTIFACT = os.getenv("DEFAULT_ARTIFACT", "demo_model_v1")  # for payloads that don't name one
+DEMO_ARTIFACT_FEATURES = int(os.getenv("DEMO_ARTIFACT_FEATURES", "4096"))  # size of weights made for unknown artifacts
+
+_SAFE_ID = re.compile(r"^[A-Za-z0-9_.-]+$")
+
+
+def _make_demo_artifact(path: str):
+    # Artifacts without a weights file get deterministic random weights so the demo stack has something to load.
+    rng = np.random.default_rng(zlib.crc32(os.path.basename(path).encode()))
+    os.makedirs(ARTIFACT_DIR, exist_ok=True)
+    # unique temp name: threads of one process, and workers sharing the directory, may race to create it
+    fd, tmp = tempfile.mkstemp(dir=ARTIFACT_DIR, prefix=os.path.basename(path) + ".", suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        np.save(f, rng.standard_normal((DEMO_ARTIFACT_FEATURES, 100), dtype=np.float32))
+    os.replace(tmp, path)
+
+
+class ArtifactCache:
+    """Model weights loaded at most once per inference process and kept LRU within a byte budget.
+
+    Weights are memory-mapped read-only, so every process on the host that maps the same file
+    shares its pages through the page cache instead of holding a private copy.
+    """
+
+    def __init__(self, budget_bytes: int):
+        self.budget_bytes = budget_bytes
+        self.entries = OrderedDict()  # artifact -> read-only memmap, most recently used last
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, artifact: str) -> np.ndarray:
+        w = self.entries.get(artifact)
+        if w is not None:
+            self.hits += 1
+            self.entries.move_to_end(artifact)
+            return w
+        self.misses += 1
+        if not _SAFE_ID.match(artifact):
+            raise ValueError(f"invalid artifact name {artifact!r}")
+        path = os.path.join(ARTIFACT_DIR, f"{artifact}.npy")
+        if not os.path.exists(path):
+            _make_demo_artifact(path)
+        w = np.load(path, mmap_mode="r")
+        self.entries[artifact] = w
+        self.bytes += w.nbytes
+        # the newest entry always stays, even if it alone is over budget
+        while self.bytes > self.budget_bytes and len(self.entries) > 1:
+            _, old = self.entries.popitem(last=False)
+            self.bytes -= old.nbytes
+            self.evictions += 1
+        return w
+
+    def stats(self) -> dict:
+        return {"entries": len(self.entries), "bytes": self.bytes, "hits": self.hits,
+                "misses": self.misses, "evictions": self.evictions}
+
+
+_artifacts = None  # ArtifactCache of the pool process this module runs in
+
+
+def _infer(n_rows: int, artifact: str) -> Tuple[np.ndarray, int, dict]:
+    """Runs in a pool process: the model's forward pass over n_rows submissions.
+
+    Returns the predictions plus this process's pid and cache stats for the parent to aggregate.
+    """
+    global _artifacts
+    if _artifacts is None:
+        _artifacts = ArtifactCache(ARTIFACT_CACHE_BYTES)
+    w = _artifacts.get(artifact)
+    # Simulate inference time; a batched forward pass costs about as much as a single one
+    time.sleep(0.05 + random.random() * 0.05)
+    # Mock features through the real weights
+    x = np.random.random((n_rows, w.shape[0])).astype(np.float32)
+    yhat = 1.0 / (1.0 + np.exp(-(x - 0.5) @ w / np.sqrt(w.shape[0])))
+    return yhat, os.getpid(), _artifacts.stats()
+
+
+def _encode(yhat: np.ndarray) -> str:
+    # float32 + base64 is ~3x smaller than a JSON list of doubles and cheap to parse on the evaluator
+    return base64.b64encode(yhat.astype("<f4").tobytes()).decode("ascii")
+
+
+class PoolGate:
+    """Admission control in front of the process pool.
+
+    At most `limit` jobs are inside at once; up to `procs` of them run and the rest wait for a
+    process in plain sight of /healthz. A job that doesn't fit is turned away instead of queued.
+    """
+
+    def __init__(self, procs: int, limit: int):
+        self.procs = procs
+        self.limit = max(limit, 1)
+        self.inflight = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.freed = asyncio.Event()
+
+    def free(self) -> int:
+        return self.limit - self.inflight
+
+    def try_acquire(self, n: int = 1) -> bool:
+        if self.inflight + n > self.limit:
+            self.rejected += n
+            return False
+        self.acquire(n)
+        return True
+
+    def acquire(self, n: int):
+        # leased jobs are ours already, so they are let in even if /run raced us to the last slot
+        self.inflight += n
+        self.admitted += n
+
+    def release(self, n: int = 1):
+        self.inflight -= n
+        self.freed.set()
+
+    def stats(self) -> dict:
+        return {"procs": self.procs, "limit": self.limit, "inflight": self.inflight,
+                "running": min(self.inflight, self.procs), "waiting": max(0, self.inflight - self.procs),
+                "saturation": round(self.inflight / self.limit, 3), "admitted": self.admitted, "rejected": self.rejected}
+
+
+POOL = None  # ProcessPoolExecutor running _infer
+GATE = None
+CLIENT = None  # httpx.AsyncClient for the evaluator and scheduler
+ARTIFACT_STATS = {}  # pool process pid -> latest ArtifactCache.stats() it reported
+
+
+def _artifact_of(job: dict) -> str:
+    return str(job.get("payload", {}).get("artifact") or DEFAULT_ARTIFACT)
 
-app = FastAPI(title="Worker (HTTP)")
+
+async def _infer_async(n_rows: int, artifact: str) -> np.ndarray:
+    yhat, pid, stats = await asyncio.get_running_loop().run_in_executor(POOL, _infer, n_rows, artifact)
+    ARTIFACT_STATS[pid] = stats
+    return yhat
+
+
+def _artifact_totals() -> dict:
+    totals = {"processes": len(ARTIFACT_STATS), "budget_bytes_per_process": ARTIFACT_CACHE_BYTES}
+    for key in ("entries", "bytes", "hits", "misses", "evictions"):
+        totals[key] = sum(s[key] for s in ARTIFACT_STATS.values())
+    return totals
+
+
+async def _execute_job(job: dict) -> dict:
+    try:
+        with span("inference"):
+            yhat = (await _infer_async(1, _artifact_of(job)))[0]
+        # Send for evaluation
+        with span("call.evaluator", kind="client"):
+            r = await CLIENT.post(f"{EVALUATOR_URL}/evaluate", headers=trace_headers(), json={
+                "submission_id": job["submission_id"], "challenge_id": job["challenge_id"], "pred_b64": _encode(yhat)})
+        r.raise_for_status()
+        return {"state": "SCORED", "score": r.json().get("score")}
+    except Exception as e:
+        return {"state": "FAILED", "error": str(e)}
+
+
+def _batch_span(name: str, jobs: List[dict], start: float, t0: float, kind: str = "internal"):
+    # one shared step, recorded once in each job's trace
+    dur_ms = (time.perf_counter() - t0) * 1000.0
+    for j in jobs:
+        record_span(name, j.get("trace_id"), start, dur_ms, kind, batch_size=len(jobs))
+
+
+async def _execute_batch(jobs: List[dict]) -> List[dict]:
+    """Score a batch of jobs with one inference pass and one evaluator call; one result per job."""
+    try:
+        start, t0 = time.time(), time.perf_counter()
+        # one forward pass per artifact in the batch, run side by side
+        groups = OrderedDict()  # artifact -> indices into jobs
+        for i, j in enumerate(jobs):
+            groups.setdefault(_artifact_of(j), []).append(i)
+        outs = await asyncio.gather(*[_infer_async(len(idx), a) for a, idx in groups.items()])
+        yhat = [None] * len(jobs)  # one prediction row per job; artifacts may differ in output width
+        for idx, out in zip(groups.values(), outs):
+            for i, row in zip(idx, out):
+                yhat[i] = row
+        _batch_span("inference", jobs, start, t0)
+        items = [{"submission_id": j["submission_id"], "challenge_id": j["challenge_id"], "pred_b64": _encode(row),
+                  "trace_id": j.get("trace_id")} for j, row in zip(jobs, yhat)]
+        start, t0 = time.time(), time.perf_counter()
+        try:
+            r = await CLIENT.post(f"{EVALUATOR_URL}/evaluate_batch", json={"items": items})
+        finally:
+            _batch_span("call.evaluator", jobs, start, t0, "client")
+        r.raise_for_status()
+        return [{"state": "SCORED", "score": s} for s in r.json()["scores"]]
+    except Exception as e:
+        return [{"state": "FAILED", "error": str(e)} for _ in jobs]
+
+
+async def _report(sid: str, result: dict):
+    try:
+        with span("call.scheduler", kind="client"):
+            await CLIENT.post(f"{SCHEDULER_URL}/jobs/{sid}/complete", headers=trace_headers(),
+                              json={"worker_id": WORKER_ID, **result}, timeout=10)
+    except Exception:
+        pass  # the scheduler re-queues the job once our lease expires
+
+
+async def _run_job(job: dict):
+    try:
+        with use_trace(job.get("trace_id")):
+            await _report(job["submission_id"], await _execute_job(job))
+    finally:
+        GATE.release(1)
+
+
+async def _run_batch(jobs: List[dict]):
+    try:
+        for job, result in zip(jobs, await _execute_batch(jobs)):
+            with use_trace(job.get("trace_id")):
+                await _report(job["submission_id"], result)
+    finally:
+        GATE.release(len(jobs))
+
+
+async def _heartbeat_loop():
+    """Register with the scheduler, then keep the registration fresh."""
+    registered = False
+    while True:
+        try:
+            if not registered:
+                (await CLIENT.post(f"{SCHEDULER_URL}/workers/register", timeout=5, json={
+                    "worker_id": WORKER_ID, "url": WORKER_ADVERTISE_URL, "capacity": GATE.limit})).raise_for_status()
+                registered = True
+            r = await CLIENT.post(f"{SCHEDULER_URL}/workers/{WORKER_ID}/heartbeat", json={"inflight": GATE.inflight}, timeout=5)
+            registered = r.status_code != 404  # scheduler restarted and forgot us
+        except Exception:
+            registered = False
+        await asyncio.sleep(HEARTBEAT_S)
+
+
+async def _pull_loop():
+    """Lease only as many jobs as the pool has room for, and run them."""
+    while True:
+        free = GATE.free()
+        if free <= 0:
+            GATE.freed.clear()
+            await GATE.freed.wait()
+            continue
+        max_jobs = min(free, BATCH_MAX_SIZE) if BATCH_MODE else free
+        try:
+            r = await CLIENT.post(f"{SCHEDULER_URL}/lease", timeout=LEASE_WAIT_S + 5,
+                                  json={"worker_id": WORKER_ID, "max_jobs": max_jobs, "wait_s": LEASE_WAIT_S})
+            r.raise_for_status()
+            jobs = r.json()["jobs"]
+        except Exception:
+            jobs = []
+            await asyncio.sleep(1.0)
+        if not jobs:
+            continue
+        GATE.acquire(len(jobs))
+        if BATCH_MODE:
+            # a leased batch is already a micro-batch
+            asyncio.ensure_future(_run_batch(jobs))
+        else:
+            for job in jobs:
+                asyncio.ensure_future(_run_job(job))
+
+
+class MicroBatcher:
+    """Collects concurrent /run calls for up to BATCH_WINDOW_MS or BATCH_MAX_SIZE jobs, then runs them together."""
+
+    def __init__(self, window_s: float, max_size: int):
+        self.window_s = window_s
+        self.max_size = max_size
+        self.queue = asyncio.Queue()
+
+    def submit(self, job: dict) -> asyncio.Future:
+        """Queue a job; the returned future gets its result once the batch it lands in has run."""
+        fut = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((job, fut))
+        return fut
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.window_s
+            while len(batch) < self.max_size:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            # don't wait for this batch; keep collecting the next one meanwhile
+            asyncio.ensure_future(self._dispatch(batch))
+
+    async def _dispatch(self, batch):
+        results = await _execute_batch([job for job, _ in batch])
+        for (_, fut), result in zip(batch, results):
+            if not fut.done():
+                fut.set_result(result)
+
+
+_batcher = None
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global _batcher, POOL, GATE, CLIENT
+    # spawn, not fork: this process already runs an event loop and threads
+    POOL = ProcessPoolExecutor(max_workers=INFERENCE_PROCS, mp_context=multiprocessing.get_context("spawn"))
+    await asyncio.gather(*[asyncio.get_running_loop().run_in_executor(POOL, os.getpid)
+                           for _ in range(INFERENCE_PROCS)])  # start them now, not on the first job
+    GATE = PoolGate(INFERENCE_PROCS, WORKER_CONCURRENCY)
+    CLIENT = httpx.AsyncClient(timeout=30, limits=httpx.Limits(max_connections=WORKER_CONCURRENCY + 8))
+    tasks = [asyncio.create_task(_heartbeat_loop())]
+    if BATCH_MODE:
+        _batcher = MicroBatcher(BATCH_WINDOW_MS / 1000.0, BATCH_MAX_SIZE)
+        tasks.append(asyncio.create_task(_batcher.run()))
+    if PULL_ENABLED:
+        tasks.append(asyncio.create_task(_pull_loop()))
+    yield
+    for t in tasks:
+        t.cancel()
+    await CLIENT.aclose()
+    POOL.shutdown(wait=False)
+
+
+app = FastAPI(title="Worker (HTTP)", lifespan=lifespan)
+app.add_middleware(TracingMiddleware, service="worker")
 
 class RunReq(BaseModel):
     submission_id: str
@@ -12,11 +371,25 @@ class RunReq(BaseModel):
     challenge_id: str
 
 @app.post("/run")
-def run(r: RunReq):
-    # Simulate inference time
-    time.sleep(0.05 + random.random() * 0.05)
-    # Produce mock predictions
-    yhat = [random.random() for _ in range(100)]
-    # Send for evaluation
-    requests.post(f"{EVALUATOR_URL}/evaluate", json={"submission_id": r.submission_id, "challenge_id": r.challenge_id, "pred": yhat})
-    return {"ok": True}
+async def run(r: RunReq):
+    if not GATE.try_acquire(1):
+        # every slot is taken; fail fast so the caller can try another replica
+        raise HTTPException(503, "worker saturated", headers={"Retry-After": "1"})
+    if _batcher is not None:
+        work = _batcher.submit({**r.model_dump(), "trace_id": current_trace_id()})
+    else:
+        work = asyncio.ensure_future(_execute_job(r.model_dump()))
+    # the slot is held until the work is done, even if this caller disconnects first
+    work.add_done_callback(lambda _: GATE.release(1))
+    result = await asyncio.shield(work)
+    return {"ok": result["state"] == "SCORED", **result}
+
+@app.get("/healthz")
+async def healthz():
+    return {"worker_id": WORKER_ID, "inflight": GATE.inflight, "capacity": GATE.limit, "pool": GATE.stats(),
+            "artifacts": _artifact_totals()}
+
+@app.get("/artifacts")
+async def artifacts():
+    """Artifact cache counters, summed and per inference process (as of each one's last job)."""
+    return {**_artifact_totals(), "per_process": ARTIFACT_STATS}
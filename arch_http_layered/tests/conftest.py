@@ -0,0 +1,12 @@
+import importlib.util, os, sys
+
+SERVICES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "services")
+sys.path.insert(0, SERVICES)  # `common` is importable as in the images
+
+
+def load_service(name: str):
+    """Import services/<name>/app.py under its own module name (every service's module is `app`)."""
+    spec = importlib.util.spec_from_file_location(f"{name}_app", os.path.join(SERVICES, name, "app.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
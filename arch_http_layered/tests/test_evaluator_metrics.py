@@ -0,0 +1,51 @@
+import itertools, threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from conftest import load_service
+
+evaluator = load_service("evaluator")
+
+
+def pairwise_auc(p, y):
+    pos = [v for v, t in zip(p, y) if t]
+    neg = [v for v, t in zip(p, y) if not t]
+    wins = sum(1.0 if a > b else 0.5 if a == b else 0.0 for a, b in itertools.product(pos, neg))
+    return wins / (len(pos) * len(neg))
+
+
+def test_constant_prediction_scores_half_for_any_label_order():
+    for y in ([1, 1, 0, 0], [0, 0, 1, 1], [0, 1, 0, 1, 1, 0, 0]):
+        P = np.full((1, len(y)), 0.7, dtype=np.float32)
+        assert evaluator.compute_metrics(P, np.array(y))["auc"][0] == 0.5
+
+
+def test_partially_tied_auc_matches_pairwise():
+    rng = np.random.default_rng(0)
+    y = rng.integers(0, 2, 200)
+    P = rng.integers(0, 5, (8, 200)).astype(np.float32) / 4  # few distinct values: many ties
+    auc = evaluator.compute_metrics(P, y)["auc"]
+    for row, got in zip(P, auc):
+        assert np.isclose(got, pairwise_auc(row, y))
+
+
+def test_midranks_average_ties():
+    ranks = evaluator.midranks(np.array([[0.3, 0.1, 0.3, 0.2, 0.3]]))
+    assert ranks.tolist() == [[4.0, 1.0, 4.0, 2.0, 4.0]]
+
+
+def test_concurrent_first_load_of_demo_labels(monkeypatch, tmp_path):
+    monkeypatch.setattr(evaluator, "LABELS_DIR", str(tmp_path))
+    monkeypatch.setattr(evaluator, "_LABELS", evaluator.OrderedDict())
+    challenges = [f"cold{i}" for i in range(10)]
+    for cid in challenges:
+        start = threading.Barrier(32)
+
+        def load(_):
+            start.wait()
+            return evaluator.get_labels(cid, 100)
+
+        with ThreadPoolExecutor(32) as pool:
+            labels = list(pool.map(load, range(32)))
+        assert all(y.shape == (100,) and (y == labels[0]).all() for y in labels)
+    assert sorted(p.name for p in tmp_path.iterdir()) == sorted(f"{cid}.npy" for cid in challenges)
@@ -0,0 +1,44 @@
+import asyncio, sqlite3, time
+
+from conftest import load_service
+
+scheduler = load_service("scheduler")
+
+
+class FlakyArchive:
+    def __init__(self, failures: int):
+        self.failures = failures
+        self.rows = []
+
+    def append(self, rows):
+        if self.failures:
+            self.failures -= 1
+            raise sqlite3.OperationalError("database is locked")
+        self.rows.extend(rows)
+
+
+def test_failed_append_keeps_jobs_and_the_loop_retries(monkeypatch):
+    archive = FlakyArchive(failures=1)
+    monkeypatch.setattr(scheduler, "ARCHIVE", archive)
+    monkeypatch.setattr(scheduler, "ARCHIVE_INTERVAL_S", 0.05)
+    monkeypatch.setattr(scheduler, "ARCHIVE_AFTER_S", 0.0)
+    for sid in ("a", "b"):
+        job = scheduler.Job("u", "c", {})
+        job.state = scheduler.State.SCORED
+        scheduler.SUBMISSIONS[sid] = job
+        scheduler.FINISHED.append((time.monotonic(), sid))
+
+    async def scenario():
+        task = asyncio.ensure_future(scheduler._archive_finished())
+        while archive.failures:  # first round fails
+            await asyncio.sleep(0.001)
+        assert set(scheduler.SUBMISSIONS) == {"a", "b"} and len(scheduler.FINISHED) == 2
+        for _ in range(200):  # the next round retries the same batch
+            if archive.rows:
+                break
+            await asyncio.sleep(0.01)
+        task.cancel()
+
+    asyncio.run(scenario())
+    assert [r[0] for r in archive.rows] == ["a", "b"]
+    assert not scheduler.SUBMISSIONS and not scheduler.FINISHED
@@ -0,0 +1,60 @@
+import os, time
+
+from common import scorelog
+from common.scorelog import ScoreLog
+
+
+def test_flusher_survives_a_failed_fsync_and_retries(monkeypatch, tmp_path):
+    log = ScoreLog(str(tmp_path), lambda: [])
+    assert log.recover() == {}
+    real_fsync, calls = os.fsync, []
+
+    def flaky_fsync(fd):
+        calls.append(fd)
+        if len(calls) == 1:
+            raise OSError(5, "Input/output error")
+        real_fsync(fd)
+
+    monkeypatch.setattr(scorelog.os, "fsync", flaky_fsync)
+    log.start()
+    log.append("c", "s1", 0.5)
+    log.append("c", "s2", 0.7)
+    deadline = time.monotonic() + 5
+    while log.stats["appended"] < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    log.close()
+    assert log.stats["errors"] == 1 and "Input/output error" in log.stats["last_error"]
+    assert log.stats["appended"] == 2
+    assert ScoreLog(str(tmp_path), lambda: []).recover() == {"c": {"s1": 0.5, "s2": 0.7}}
+
+
+def test_failed_write_leaves_no_partial_record(monkeypatch, tmp_path):
+    log = ScoreLog(str(tmp_path), lambda: [])
+    log.recover()
+    log.append("c", "s1", 0.5)
+    log._flush()
+    good = os.path.getsize(log._path("scores", log.gen))
+
+    class HalfWriter:
+        def __init__(self, f):
+            self.f = f
+
+        def fileno(self):
+            return self.f.fileno()
+
+        def write(self, data):
+            self.f.write(bytes(data[:5]))
+            raise OSError(28, "No space left on device")
+
+    real = log.file
+    log.file = HalfWriter(real)
+    log.append("c", "s2", 0.7)
+    try:
+        log._flush()
+    except OSError:
+        pass
+    assert os.path.getsize(log._path("scores", log.gen)) == good
+    log.file = real
+    log._flush()
+    log.file.close()
+    assert ScoreLog(str(tmp_path), lambda: []).recover() == {"c": {"s1": 0.5, "s2": 0.7}}
@@ -0,0 +1,17 @@
+import pytest
+
+from common.store import MemoryStore, SQLiteStore, Store
+
+
+def test_backends_implement_every_method(tmp_path):
+    MemoryStore()
+    SQLiteStore(str(tmp_path / "store.db"))
+
+
+def test_incomplete_backend_fails_at_construction():
+    class Partial(Store):
+        def get(self, ns, key):
+            return None
+
+    with pytest.raises(TypeError):
+        Partial()
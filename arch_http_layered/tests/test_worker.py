@@ -0,0 +1,54 @@
+import asyncio, base64
+import httpx
+import numpy as np
+
+from conftest import load_service
+
+worker = load_service("worker")
+
+
+def test_slot_held_until_batched_work_finishes_after_caller_cancels(monkeypatch):
+    async def scenario():
+        done = asyncio.Event()
+
+        async def slow_batch(jobs):
+            await done.wait()
+            return [{"state": "SCORED", "score": 1.0} for _ in jobs]
+
+        monkeypatch.setattr(worker, "_execute_batch", slow_batch)
+        monkeypatch.setattr(worker, "GATE", worker.PoolGate(1, 1))
+        batcher = worker.MicroBatcher(0.0, 8)
+        monkeypatch.setattr(worker, "_batcher", batcher)
+        runner = asyncio.ensure_future(batcher.run())
+        call = asyncio.ensure_future(worker.run(worker.RunReq(submission_id="s", payload={}, challenge_id="c")))
+        await asyncio.sleep(0.01)
+        call.cancel()
+        await asyncio.sleep(0.01)
+        assert worker.GATE.inflight == 1  # the batch is still running
+        done.set()
+        await asyncio.sleep(0.01)
+        assert worker.GATE.inflight == 0
+        runner.cancel()
+
+    asyncio.run(scenario())
+
+
+def test_batch_with_artifacts_of_different_output_widths(monkeypatch):
+    widths = {"small": 10, "large": 250}
+    sent = []
+
+    async def fake_infer(n_rows, artifact):
+        return np.full((n_rows, widths[artifact]), 0.5, dtype=np.float32)
+
+    class FakeClient:
+        async def post(self, url, json):
+            sent.extend(json["items"])
+            return httpx.Response(200, json={"scores": [0.5] * len(json["items"])}, request=httpx.Request("POST", url))
+
+    monkeypatch.setattr(worker, "_infer_async", fake_infer)
+    monkeypatch.setattr(worker, "CLIENT", FakeClient())
+    jobs = [{"submission_id": str(i), "challenge_id": "c", "payload": {"artifact": a}}
+            for i, a in enumerate(["small", "large", "small"])]
+    results = asyncio.run(worker._execute_batch(jobs))
+    assert [r["state"] for r in results] == ["SCORED"] * 3
+    assert [len(base64.b64decode(item["pred_b64"])) // 4 for item in sent] == [10, 250, 10]